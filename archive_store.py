@@ -0,0 +1,316 @@
+import hashlib
+import json
+import lzma
+import os
+import queue
+import shutil
+import sys
+import threading
+import zipfile
+import zlib
+from time import time
+from colorama import Fore
+import metrics
+import leagues
+
+WARN = f'{Fore.YELLOW}[WRN]{Fore.RESET} '
+
+# Replaces the copies of every submitted zip in data/match_replays
+# Each file inside an archive is stored once under blobs/ by its sha256, so a resubmission under another name or
+# a re-zipped rehost fix only adds the files that actually changed
+# Blobs are written as they are while the archive is extracted, so storing never holds up r6-dissect. Once the
+# archive has been parsed, a background thread recompresses its new blobs with lzma (see compact_later), keeping
+# the .xz only if it is smaller. .rec files are already compressed, so anything whose first chunk zlib can't
+# shrink by COMPRESSIBLE is left alone without running lzma at all
+# An archive is a manifest of (path, blob) pairs, its id is the hash of that manifest so the same replays zipped
+# twice get the same id. names.json maps submitted filenames to the ids submitted under them, oldest first, since
+# the same name (usually Match.zip) is reused all the time, and matches.json maps every map's match id to ids
+STORE_DIR = os.path.join('data', 'archive_store')
+LEGACY_DIR = os.path.join('data', 'match_replays')
+LZMA_PRESET = 6
+CHUNK_SIZE = 1024 * 1024
+COMPRESSIBLE = 0.9  # Compressed to uncompressed ratio of the first chunk below which lzma is tried
+
+lock = threading.Lock()
+compact_queue = queue.Queue()  # (league, archive id) waiting to be compacted
+thread = None
+
+
+def store_path(*parts):
+    return leagues.path(STORE_DIR, *parts)
+
+
+def read_index(name):
+    index_file = store_path(f'{name}.json')
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file, 'r') as f:
+        return json.load(f)
+
+
+def write_index(name, index):
+    index_file = store_path(f'{name}.json')
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_file + '.tmp', index_file)
+
+
+def blob_path(digest, compressed=False):
+    return store_path('blobs', digest[:2], f'{digest}.xz' if compressed else digest)
+
+
+def has_blob(digest):
+    return os.path.exists(blob_path(digest, compressed=True)) or os.path.exists(blob_path(digest))
+
+
+def hash_member(z, info):
+    digest = hashlib.sha256()
+    with z.open(info) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def add_blob(z, info, digest):
+    # Returns the bytes written, 0 if the store already had this file
+    if has_blob(digest):
+        return 0
+    path = blob_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with z.open(info) as src, open(path + '.tmp', 'wb') as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    os.replace(path + '.tmp', path)
+    return os.path.getsize(path)
+
+
+def compress_blob(digest):
+    # Returns the bytes saved, 0 if the blob is left as it is
+    path = blob_path(digest)
+    compressed = blob_path(digest, compressed=True)
+    if os.path.exists(compressed):
+        if os.path.exists(path):
+            # Left behind when it was still open the last time
+            os.remove(path)
+        return 0
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, 'rb') as f:
+        sample = f.read(CHUNK_SIZE)
+    if not sample or len(zlib.compress(sample, 1)) > len(sample) * COMPRESSIBLE:
+        return 0
+    with metrics.span('compress_blob'), open(path, 'rb') as src, lzma.open(compressed + '.tmp', 'wb', preset=LZMA_PRESET) as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    saved = os.path.getsize(path) - os.path.getsize(compressed + '.tmp')
+    if saved <= 0:
+        os.remove(compressed + '.tmp')
+        return 0
+    os.replace(compressed + '.tmp', compressed)
+    os.remove(path)
+    return saved
+
+
+def compact(key=None):
+    # Compresses an archive's blobs, or every blob in the store, returns the bytes saved
+    if key is None:
+        digests = []
+        for _, _, files in os.walk(store_path('blobs')):
+            digests += [file for file in files if '.' not in file]
+    else:
+        archive = manifest(key)
+        digests = [] if archive is None else [file['sha256'] for file in archive['files']]
+    return sum(compress_blob(digest) for digest in digests)
+
+
+def compact_later(archive_id):
+    # Called once an archive is parsed, so recompressing it never competes with getting its stats out
+    global thread
+    compact_queue.put((leagues.current(), archive_id))
+    with lock:
+        if thread is None:
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+
+
+def run():
+    while True:
+        league, archive_id = compact_queue.get()
+        try:
+            leagues.run_as(league, compact, archive_id)
+        except Exception as e:
+            # Usually a blob another process has open, python archive_store.py --compact picks it up later
+            print(WARN + f'Could not compress archive {archive_id[:12]} in {league["name"]}: {e}')
+
+
+def manifest_id(files):
+    # files sorted by path
+    return hashlib.sha256(json.dumps([(file['path'], file['sha256']) for file in files]).encode('utf-8')).hexdigest()
+
+
+def identify(zip_path):
+    # The id a zip would get in the store, without storing it
+    with zipfile.ZipFile(zip_path, 'r') as z:
+        files = [{'path': info.filename, 'sha256': hash_member(z, info)} for info in z.infolist() if not info.is_dir()]
+    return manifest_id(sorted(files, key=lambda file: file['path']))
+
+
+def store(zip_path, name=None):
+    # Adds an archive to the store, returns its id and whether it was already there
+    name = name or os.path.basename(zip_path)
+    with metrics.span('archive_store', file=name), zipfile.ZipFile(zip_path, 'r') as z:
+        files = []
+        written = 0
+        for info in z.infolist():
+            if info.is_dir():
+                continue
+            digest = hash_member(z, info)
+            written += add_blob(z, info, digest)
+            files.append({'path': info.filename, 'sha256': digest, 'size': info.file_size})
+    files.sort(key=lambda file: file['path'])
+    archive_id = manifest_id(files)
+
+    with lock:
+        manifest_file = store_path('archives', f'{archive_id}.json')
+        existed = os.path.exists(manifest_file)
+        if not existed:
+            os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+            with open(manifest_file + '.tmp', 'w') as f:
+                json.dump({'id': archive_id, 'name': name, 'added': time(), 'files': files, 'stored bytes': written}, f)
+            os.replace(manifest_file + '.tmp', manifest_file)
+        names = read_index('names')
+        ids = names.setdefault(name, [])
+        if archive_id in ids:
+            ids.remove(archive_id)
+        ids.append(archive_id)
+        write_index('names', names)
+    return archive_id, existed
+
+
+def forget(name, archive_id):
+    # Drops one submission of a filename, its blobs stay so a fixed version of the same replays dedupes against them
+    with lock:
+        names = read_index('names')
+        ids = names.get(name, [])
+        if archive_id in ids:
+            ids.remove(archive_id)
+        if not ids:
+            names.pop(name, None)
+        write_index('names', names)
+
+
+def link_matches(match_ids, archive_id):
+    # Every map's id, the rest of the pipeline keys its data by map
+    with lock:
+        matches = read_index('matches')
+        for match_id in match_ids:
+            matches[match_id] = archive_id
+        write_index('matches', matches)
+
+
+def resolve(key):
+    # Accepts an archive id, a submitted filename (its latest submission) or a match id
+    if os.path.exists(store_path('archives', f'{key}.json')):
+        return key
+    ids = read_index('names').get(key)
+    return ids[-1] if ids else read_index('matches').get(key)
+
+
+def manifest(key):
+    archive_id = resolve(key)
+    if archive_id is None:
+        return None
+    with open(store_path('archives', f'{archive_id}.json'), 'r') as f:
+        return json.load(f)
+
+
+def has(key):
+    return resolve(key) is not None
+
+
+def files_for_match(match_id):
+    archive = manifest(match_id)
+    return [] if archive is None else archive['files']
+
+
+def open_blob(digest):
+    if os.path.exists(blob_path(digest, compressed=True)):
+        return lzma.open(blob_path(digest, compressed=True), 'rb')
+    try:
+        return open(blob_path(digest), 'rb')
+    except FileNotFoundError:
+        # Compressed since the check above
+        return lzma.open(blob_path(digest, compressed=True), 'rb')
+
+
+def extract(key, dest):
+    # Writes an archive's files straight into a folder, the same layout as extracting the original zip
+    archive = manifest(key)
+    if archive is None:
+        raise KeyError(f'{key} is not in the archive store')
+    for file in archive['files']:
+        path = os.path.join(dest, file['path'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open_blob(file['sha256']) as src, open(path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def export(key, zip_path):
+    # Rebuilds a zip of an archive, e.g. to put it back in the replay buffer
+    archive = manifest(key)
+    if archive is None:
+        raise KeyError(f'{key} is not in the archive store')
+    with zipfile.ZipFile(zip_path + '.tmp', 'w', zipfile.ZIP_DEFLATED) as z:
+        for file in archive['files']:
+            with open_blob(file['sha256']) as src, z.open(file['path'], 'w') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    os.replace(zip_path + '.tmp', zip_path)
+
+
+def migrate():
+    # Moves the zips left in data/match_replays into the store
+    legacy_dir = leagues.path(LEGACY_DIR)
+    for file in sorted(os.listdir(legacy_dir)):
+        if not file.endswith('.zip'):
+            continue
+        archive_id, existed = store(os.path.join(legacy_dir, file), file)
+        compact(archive_id)
+        print(f'{file} -> {archive_id[:12]}{" (duplicate)" if existed else ""}')
+        os.remove(os.path.join(legacy_dir, file))
+
+
+def usage():
+    # Bytes the original files would take against bytes actually on disk
+    original, stored = 0, 0
+    archives_dir = store_path('archives')
+    if os.path.exists(archives_dir):
+        for file in os.listdir(archives_dir):
+            with open(os.path.join(archives_dir, file), 'r') as f:
+                original += sum(member['size'] for member in json.load(f)['files'])
+    for root, _, files in os.walk(store_path('blobs')):
+        stored += sum(os.path.getsize(os.path.join(root, file)) for file in files)
+    return {'original': original, 'stored': stored}
+
+
+def main():
+    # python archive_store.py --migrate | --compact | --usage | --export <name, match id or archive id> <zip path> [--league NAME]
+    # --compact compresses every blob still stored as it is, e.g. ones queued when the parser last stopped
+    if '--league' in sys.argv:
+        league = leagues.get_league(sys.argv[sys.argv.index('--league') + 1])
+    else:
+        league = leagues.all_leagues()[0]
+    with leagues.use(league):
+        if '--migrate' in sys.argv:
+            migrate()
+        elif '--compact' in sys.argv:
+            print(f'Saved {compact() / 1024 / 1024:.1f} MB')
+        elif '--export' in sys.argv:
+            i = sys.argv.index('--export')
+            export(sys.argv[i + 1], sys.argv[i + 2])
+        else:
+            result = usage()
+            print(f'{result["original"] / 1024 / 1024:.1f} MB of replays stored in {result["stored"] / 1024 / 1024:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
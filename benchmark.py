@@ -0,0 +1,155 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import tracemalloc
+from time import perf_counter
+import pandas as pd
+from tabulate import tabulate
+import metrics
+import reference_data
+import replay_parser
+import stats_manager
+import synthetic_data
+
+SIZES = {
+    'small': {'rounds': 7, 'kill_density': 4.0, 'feed_density': 1.0, 'maps': 1, 'map_history': 20, 'match_history': 5},
+    'medium': {'rounds': 12, 'kill_density': 6.0, 'feed_density': 2.0, 'maps': 3, 'map_history': 200, 'match_history': 20},
+    'large': {'rounds': 24, 'kill_density': 8.0, 'feed_density': 6.0, 'maps': 3, 'map_history': 1000, 'match_history': 60},
+}
+REGRESSION_THRESHOLD = 0.2
+
+
+def measure(fn, setup=None, repeat=3):
+    # Timings are taken without tracemalloc, then one extra run measures peak memory
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            if setup:
+                setup()
+            start = perf_counter()
+            fn()
+            times.append(perf_counter() - start)
+
+        if setup:
+            setup()
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {'min': min(times), 'median': statistics.median(times), 'peak_mb': peak / 1024 / 1024}
+
+
+def use_fake_client(roster):
+    client = synthetic_data.FakeClient(roster)
+    replay_parser.client = client
+    stats_manager.client = client
+    reference_data.clear()
+    return client
+
+
+def make_player_stats_history(roster, size, maps):
+    # Tile a handful of parsed maps so large histories stay cheap to build
+    teams = [row[0] for row in roster[1:]]
+    frames = []
+    for i in range(min(maps, 20)):
+        replay_json = synthetic_data.generate_replay(roster, teams[i % len(teams)], teams[(i + 1) % len(teams)], seed=i, **size)
+        frames.append(replay_parser.parse_json_player_stats(replay_json)[1])
+    return pd.concat(frames * (maps // len(frames) + 1), ignore_index=True).head(maps * len(frames[0]))
+
+
+def make_match_log_history(roster, size, matches):
+    teams = [row[0] for row in roster[1:]]
+    frames = []
+    for i in range(min(matches, 20)):
+        replay_jsons = synthetic_data.generate_series(roster, teams[i % len(teams)], teams[(i + 3) % len(teams)], size['maps'], size['rounds'], size['kill_density'], size['feed_density'], seed=i)
+        frames.append(replay_parser.parse_json_match_log(replay_jsons)[1])
+    return pd.concat(frames * (matches // len(frames) + 1), ignore_index=True).head(matches * 2)
+
+
+def run_benchmarks(sizes, repeat):
+    roster = synthetic_data.make_roster()
+    team_1, team_2 = roster[1][0], roster[2][0]
+    results = []
+
+    for size_name in sizes:
+        size = SIZES[size_name]
+        replay_args = {key: size[key] for key in ('rounds', 'kill_density', 'feed_density')}
+        with contextlib.redirect_stdout(io.StringIO()):
+            use_fake_client(roster)
+            replay_json = synthetic_data.generate_replay(roster, team_1, team_2, **replay_args)
+            replay_jsons = synthetic_data.generate_series(roster, team_1, team_2, size['maps'], **replay_args)
+            player_history = make_player_stats_history(roster, replay_args, size['map_history'])
+            match_history = make_match_log_history(roster, size, size['match_history'])
+            new_player_stats = replay_parser.parse_json_player_stats(replay_json)[1]
+
+        def setup_player_stats():
+            player_history.to_csv('data/raw_player_stats.csv', index=False)
+            new_player_stats.to_csv('cache/write_cache/player_stats-bench.csv', index=False)
+
+        def setup_match_log():
+            match_history.to_csv('data/match_log.csv', index=False)
+
+        cases = [
+            ('parse_json_player_stats', f'{size["rounds"]} rounds', lambda: replay_parser.parse_json_player_stats(replay_json), None),
+            ('parse_json_match_log', f'{size["maps"]} maps', lambda: replay_parser.parse_json_match_log(replay_jsons), None),
+            ('write_player_stats', f'{len(player_history)} raw rows', lambda: stats_manager.write_player_stats('player_stats-bench.csv'), setup_player_stats),
+            ('update_map_stats', f'{len(match_history)} log rows', stats_manager.update_map_stats, setup_match_log),
+        ]
+        for name, input_size, fn, setup in cases:
+            result = measure(fn, setup, repeat)
+            results.append({'function': name, 'size': size_name, 'input': input_size, **result})
+    return results
+
+
+def compare(results, baseline):
+    baseline = {(row['function'], row['size']): row for row in baseline}
+    for row in results:
+        old = baseline.get((row['function'], row['size']))
+        row['change'] = ''
+        if old:
+            change = row['median'] / old['median'] - 1
+            row['change'] = f'{change:+.0%}' + (' REGRESSION' if change > REGRESSION_THRESHOLD else '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stats pipeline against synthetic r6-dissect output')
+    parser.add_argument('--sizes', nargs='+', choices=SIZES.keys(), default=list(SIZES.keys()))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='write results to this json file')
+    parser.add_argument('--compare', help='compare against results saved with --save')
+    args = parser.parse_args()
+
+    # Run inside a scratch directory so the real data/ and cache/ folders are never touched, and keep the
+    # synthetic spans out of the real logs/
+    metrics.ENABLED = False
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='qcc-bench-')
+    os.makedirs(os.path.join(workdir, 'data'))
+    os.makedirs(os.path.join(workdir, 'cache', 'write_cache'))
+    os.chdir(workdir)
+    try:
+        results = run_benchmarks(args.sizes, args.repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(results, json.load(f))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    rows = []
+    for row in results:
+        rows.append([row['function'], row['size'], row['input'], f'{row["min"] * 1000:.1f}', f'{row["median"] * 1000:.1f}', f'{row["peak_mb"]:.1f}', row.get('change', '')])
+    print(tabulate(rows, headers=['Function', 'Size', 'Input', 'Min (ms)', 'Median (ms)', 'Peak (MB)', 'vs Baseline'], tablefmt='grid'))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,13 @@
 import os
+import asyncio
 import discord
 from dotenv import load_dotenv
-import pandas as pd
-from tabulate import tabulate
+import metrics
+import leagues
+import command_pool
+import stats_snapshot
+import head_to_head
+import live_series
 
 
 load_dotenv()
@@ -17,69 +22,105 @@ client = discord.Client(intents=intents)
 async def on_ready():
     print(f'{client.user} has connected to Discord!')
 
+    # Warm every league's stats snapshot and head-to-head index off the event loop so the first command doesn't pay for it
+    loop = asyncio.get_running_loop()
+    for league in leagues.all_leagues():
+        if leagues.run_as(league, stats_snapshot.has_stats):
+            await loop.run_in_executor(None, leagues.run_as, league, stats_snapshot.load_snapshot)
+        await loop.run_in_executor(None, leagues.run_as, league, head_to_head.load_index)
 
-async def g_stats(message):
-    if message.content.startswith('teams'):
-        df = pd.read_csv('data/player_stats.csv')
-        teams = sorted(list(df['Team'].unique()))
-        await message.reply(f'Teams:\n- {"\n- ".join(teams)}')
 
-    elif message.content.startswith('stats'):
-        df = pd.read_csv('data/player_stats.csv')
+# Commands build their replies in command_pool's worker threads and return the messages to send
+def g_stats(content):
+    snapshot = stats_snapshot.load_snapshot()
+
+    if content.startswith('teams'):
+        teams = '\n- '.join(snapshot['teams'])
+        return [f'Teams:\n- {teams}']
+
+    elif content.startswith('stats'):
+        team = None
 
         # Team specified, so filter by team
-        if len(message.content.split(' ')) > 2:
-            team = ' '.join(message.content.split(' ')[1:])
-            df = df[df['Team'] == team]
-            df = df[['Player', 'K/D', 'KOST', 'SRV', 'Rating', 'Headshot %', 'Entry', 'KPR']]
-
-        # No team specified, so show all teams
-        else:
-            df = df[['Team', 'Player', 'K/D', 'KOST', 'SRV', 'Rating', 'Headshot %', 'Entry', 'KPR']]
-
-        # Round K/D, KOST, SRV, Rating, KPR to 2 decimal places
-        df['K/D'] = df['K/D'].round(2)
-        df['KOST'] = df['KOST'].round(2)
-        df['SRV'] = df['SRV'].round(2)
-        df['Rating'] = df['Rating'].round(2)
-        df['KPR'] = df['KPR'].round(2)
-
-        # Change Headshot % to percentage
-        df['Headshot %'] = (df['Headshot %'] * 100).round()
-
-        # Tabulate
-        table = tabulate(df, headers='keys', tablefmt='fancy_grid', showindex=False)
-
-        # If table string > 2000 characters, split into multiple messages
-        if len(table) > 2000:
-            lines = table.split('\n')
-
-            start_index = 0
-            char_count = 0
-            for i in range(len(lines)):
-                char_count += len(lines[i])
-                if char_count > 1900:
-                    await message.reply(f'```{'\n'.join(lines[start_index:i])}```')
-                    char_count = 0
-                    start_index = i
-            await message.reply(f'```{'\n'.join(lines[start_index:])}```')
-        else:
-            await message.reply(f'**{team}**\n```{table}```')
+        if len(content.split(' ')) > 2:
+            team = ' '.join(content.split(' ')[1:])
+
+        if team not in snapshot['pages']:
+            return [f'No stats found for {team}']
+        return snapshot['pages'][team]
+
+
+def g_matches(content):
+    args = content.split(' ')[1:]
+
+    # h2h Team A vs Team B
+    if content.startswith('h2h'):
+        teams = ' '.join(args).split(' vs ')
+        if len(teams) != 2:
+            return ['Usage: h2h <team> vs <team>']
+        return [head_to_head.render_record(teams[0].strip(), teams[1].strip())]
+
+    # history Team A [page]
+    elif content.startswith('history'):
+        page = 1
+        if len(args) > 1 and args[-1].isdigit():
+            page = max(int(args.pop()), 1)
+        if not args:
+            return ['Usage: history <team> [page]']
+        return [head_to_head.render_history(' '.join(args), page)]
+
+
+COMMANDS = {
+    'teams': (g_stats, stats_snapshot.version),
+    'stats': (g_stats, stats_snapshot.version),
+    'h2h': (g_matches, head_to_head.version),
+    'history': (g_matches, head_to_head.version),
+}
+
+
+async def run_command(message, command):
+    if not command_pool.allow(message.channel.id):
+        await message.add_reaction('\u23f3')  # Hourglass, the channel is over its rate limit
+        return
+
+    # Everyone asking the same thing about the same data while it's being worked out shares one answer
+    fn, version = COMMANDS[command]
+    league = leagues.current()
+    content = ' '.join(message.content.split())
+    with metrics.span('bot.command', command=command):
+        replies = await command_pool.run((league['name'], content, version()), leagues.run_as, league, fn, content)
+    for reply in replies:
+        await message.reply(reply)
 
 
 @client.event
 async def on_message(message):
-    if message.content.startswith('teams') or message.content.startswith('stats'):
-        await g_stats(message)
+    # Commands answer for the league the channel or server belongs to
+    league = leagues.for_channel(message.channel.id, message.guild.id if message.guild else None)
+    with leagues.use(league):
+        await handle_message(message)
+
+
+async def handle_message(message):
+    for command in COMMANDS:
+        if message.content.startswith(command):
+            await run_command(message, command)
+            break
 
-    # If message sent in #match-report and isn't from the bot
-    if message.channel.id == 1228175751648509973 and message.author.id != 1223654836189397002:
+    # If message sent in the league's #match-report and isn't from the bot
+    if message.channel.id == leagues.current()['match_report_channel'] and message.author.id != leagues.load_config()['bot_user_id']:
         for file in message.attachments:
             if not file.filename.endswith('.zip'):
                 return
 
-            # Save the file to cache/replay_buffer
-            await file.save(os.path.join('cache', 'replay_buffer', file.filename))
+            # Save the file to the league's cache/replay_buffer
+            # A message starting with 'live' holds single maps of a series still being played, 'live bo1' or
+            # 'live bo3' gives the series length (the league's best_of otherwise)
+            filename = file.filename
+            if message.content.lower().startswith('live') and not filename.startswith(live_series.LIVE_PREFIX):
+                filename = live_series.submission_name(filename, live_series.best_of_from_message(message.content))
+            with metrics.span('bot.save_attachment', file=filename):
+                await file.save(leagues.path('cache', 'replay_buffer', filename))
             await message.reply(f'{file.filename} submitted successfully!')
 
 
@@ -0,0 +1,36 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+# Runs bot commands off the event loop so a burst of commands can't hold up the Discord gateway
+# Identical commands already running (same league, command, arguments and data version) share one result,
+# and each channel gets CHANNEL_RATE commands every CHANNEL_PER seconds (token bucket)
+MAX_WORKERS = 4
+CHANNEL_RATE = 5
+CHANNEL_PER = 10
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='bot-command')
+in_flight = {}  # Key -> asyncio future
+buckets = {}  # Channel id -> (tokens, last update)
+
+
+def allow(channel_id):
+    now = monotonic()
+    tokens, last = buckets.get(channel_id, (CHANNEL_RATE, now))
+    tokens = min(CHANNEL_RATE, tokens + (now - last) * CHANNEL_RATE / CHANNEL_PER)
+    if tokens < 1:
+        buckets[channel_id] = (tokens, now)
+        return False
+    buckets[channel_id] = (tokens - 1, now)
+    return True
+
+
+async def run(key, fn, *args):
+    # Only ever called from the event loop, so in_flight needs no lock
+    future = in_flight.get(key)
+    if future is None:
+        future = asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        in_flight[key] = future
+        future.add_done_callback(lambda _: in_flight.pop(key, None))
+    # One waiter giving up mustn't cancel the result the others are waiting on
+    return await asyncio.shield(future)
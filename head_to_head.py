@@ -0,0 +1,171 @@
+import json
+import os
+from datetime import datetime
+import leagues
+
+# Head-to-head records and match history by team, kept next to match_log.csv and updated by write_match_log
+# as each match is added, so the bot answers from a dict lookup instead of scanning the match log
+# Plain json so the bot can load it without pandas
+INDEX_FILE = os.path.join('data', 'head_to_head.json')
+MATCH_LOG_FILE = os.path.join('data', 'match_log.csv')
+PAGE_SIZE = 10
+TIME_FORMAT = '%m-%d-%Y %H:%M:%S'
+
+indexes = {}  # League name -> (mtime, index)
+
+
+def empty_index():
+    # pairs: team -> opponent -> record, history: team -> matches newest first, matches: keys already counted
+    # matches is a set rebuilt from history when the index loads, it isn't saved
+    return {'pairs': {}, 'history': {}, 'matches': set()}
+
+
+def match_key(entry):
+    return f'{entry["time"]}|{entry["team"]}|{entry["opponent"]}'
+
+
+def is_win(value):
+    # Win columns come back from the csv as bools, 1.0/0.0 or strings depending on which maps were empty
+    if isinstance(value, str):
+        return value == 'True'
+    return bool(value == True)
+
+
+def match_entry(row):
+    maps = []
+    for i in range(1, 4):
+        name = row[f'Map {i}']
+        if type(name) != str or name == '':
+            continue
+        maps.append({
+            'map': name,
+            'score': int(row[f'Map {i} Score']),
+            'opp score': int(row[f'Map {i} Opp Score']),
+            'win': is_win(row[f'Map {i} Win']),
+        })
+    return {
+        'time': row['Time'],
+        'timestamp': datetime.strptime(row['Time'], TIME_FORMAT).timestamp(),
+        'team': row['Team'],
+        'opponent': row['Opponent'],
+        'maps': maps,
+        'maps won': int(row['Maps Won']),
+        'maps lost': int(row['Maps Lost']),
+        'win': is_win(row['Win']),
+        'round diff': int(row['Round Diff']),
+    }
+
+
+def add(index, entry):
+    key = match_key(entry)
+    if key in index['matches']:
+        return False
+    index['matches'].add(key)
+
+    pair = index['pairs'].setdefault(entry['team'], {}).setdefault(entry['opponent'], {
+        'wins': 0, 'losses': 0, 'maps won': 0, 'maps lost': 0, 'round diff': 0, 'maps': {}
+    })
+    pair['wins' if entry['win'] else 'losses'] += 1
+    pair['maps won'] += entry['maps won']
+    pair['maps lost'] += entry['maps lost']
+    pair['round diff'] += entry['round diff']
+    for map_ in entry['maps']:
+        map_record = pair['maps'].setdefault(map_['map'], {'wins': 0, 'losses': 0, 'round diff': 0})
+        map_record['wins' if map_['win'] else 'losses'] += 1
+        map_record['round diff'] += map_['score'] - map_['opp score']
+
+    # Newest first, matches are almost always added in order so this rarely moves anything
+    history = index['history'].setdefault(entry['team'], [])
+    i = 0
+    while i < len(history) and history[i]['timestamp'] > entry['timestamp']:
+        i += 1
+    history.insert(i, entry)
+    return True
+
+
+def write_index(index):
+    index_file = leagues.path(INDEX_FILE)
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump({'pairs': index['pairs'], 'history': index['history']}, f)
+    os.replace(index_file + '.tmp', index_file)
+    indexes[leagues.current()['name']] = (os.path.getmtime(index_file), index)
+
+
+def rebuild():
+    # Builds the index from the whole match log, only needed once for leagues that predate it
+    import pandas as pd
+    index = empty_index()
+    if os.path.exists(leagues.path(MATCH_LOG_FILE)):
+        for _, row in pd.read_csv(leagues.path(MATCH_LOG_FILE)).iterrows():
+            add(index, match_entry(row))
+    write_index(index)
+    return index
+
+
+def update(df):
+    # df is the match log rows for the new match, one per team
+    if not os.path.exists(leagues.path(INDEX_FILE)):
+        rebuild()
+        return
+    index = load_index()
+    changed = False
+    for _, row in df.iterrows():
+        changed = add(index, match_entry(row)) or changed
+    if changed:
+        write_index(index)
+
+
+def version():
+    index_file = leagues.path(INDEX_FILE)
+    return os.path.getmtime(index_file) if os.path.exists(index_file) else None
+
+
+def load_index():
+    league = leagues.current()['name']
+    index_file = leagues.path(INDEX_FILE)
+    if not os.path.exists(index_file):
+        return empty_index()
+    mtime = os.path.getmtime(index_file)
+    cached_mtime, index = indexes.get(league, (None, None))
+    if mtime != cached_mtime:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+        index['matches'] = {match_key(entry) for matches in index['history'].values() for entry in matches}
+        indexes[league] = (mtime, index)
+    return index
+
+
+def record(team, opponent):
+    return load_index()['pairs'].get(team, {}).get(opponent)
+
+
+def history(team, page=1):
+    # One page of a team's matches, newest first, and the number of pages
+    matches = load_index()['history'].get(team, [])
+    pages = max((len(matches) + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+    start = (page - 1) * PAGE_SIZE
+    return matches[start:start + PAGE_SIZE], pages
+
+
+def render_record(team, opponent):
+    pair = record(team, opponent)
+    if pair is None:
+        return f'No matches found for {team} vs {opponent}'
+    lines = [
+        f'**{team} vs {opponent}**',
+        f'Matches: {pair["wins"]}-{pair["losses"]}, Maps: {pair["maps won"]}-{pair["maps lost"]}, Round Diff: {pair["round diff"]:+d}',
+    ]
+    for name, map_record in sorted(pair['maps'].items()):
+        lines.append(f'- {name}: {map_record["wins"]}-{map_record["losses"]} ({map_record["round diff"]:+d})')
+    return '\n'.join(lines)
+
+
+def render_history(team, page=1):
+    matches, pages = history(team, page)
+    if not matches:
+        return f'No matches found for {team}' if page == 1 else f'{team} only has {pages} page(s) of matches'
+    lines = [f'**{team}** (page {page}/{pages})']
+    for match in matches:
+        scores = ', '.join(f'{map_["map"]} {map_["score"]}-{map_["opp score"]}' for map_ in match['maps'])
+        lines.append(f'{match["time"]} {"W" if match["win"] else "L"} {match["maps won"]}-{match["maps lost"]} vs {match["opponent"]} ({scores})')
+    return '\n'.join(lines)
@@ -0,0 +1,101 @@
+import os
+import shutil
+import threading
+from time import sleep, time
+from colorama import Fore
+import leagues
+
+WARN = f'{Fore.YELLOW}[WRN]{Fore.RESET} '
+ERROR = f'{Fore.RED}[ERR]{Fore.RESET} '
+ACTION = f'{Fore.CYAN}[ACT]{Fore.RESET} '
+
+# Deletes replay folders without ever holding up the parser
+# Anything that can't be deleted right away (usually a file another program still has open) is moved to the
+# league's cache/quarantine folder and retried in the background, backing off from 1 second up to 5 minutes
+QUARANTINE = os.path.join('cache', 'quarantine')
+MIN_BACKOFF = 1
+MAX_BACKOFF = 300
+REPORT_AFTER = 5  # Failed attempts before the path is reported for manual cleanup
+
+lock = threading.Lock()
+pending = {}  # Path -> {'attempts', 'next_try', 'backoff'}
+thread = None
+
+
+def delete(path):
+    try:
+        shutil.rmtree(path)
+        return True
+    except FileNotFoundError:
+        return True
+    except OSError:
+        return False
+
+
+def discard(path):
+    if delete(path):
+        return
+
+    # Move it out of the way so the folder name is free for the next archive
+    quarantine = leagues.path(QUARANTINE)
+    os.makedirs(quarantine, exist_ok=True)
+    target = os.path.join(quarantine, f'{os.path.basename(path)}-{int(time() * 1000)}')
+    try:
+        os.rename(path, target)
+        path = target
+    except OSError:
+        pass
+    print(WARN + f'   Could not delete {path}, the janitor will retry in the background')
+    retry(path)
+
+
+def retry(path):
+    global thread
+    with lock:
+        pending.setdefault(path, {'attempts': 0, 'next_try': time() + MIN_BACKOFF, 'backoff': MIN_BACKOFF})
+        if thread is None:
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+
+
+def sweep():
+    # Picks up quarantined folders left over from before a restart
+    quarantine = leagues.path(QUARANTINE)
+    if os.path.exists(quarantine):
+        for name in os.listdir(quarantine):
+            retry(os.path.join(quarantine, name))
+
+
+def run():
+    while True:
+        with lock:
+            due = [path for path, entry in pending.items() if entry['next_try'] <= time()]
+
+        for path in due:
+            deleted = delete(path)
+            with lock:
+                entry = pending[path]
+                if deleted:
+                    del pending[path]
+                    continue
+                entry['attempts'] += 1
+                entry['backoff'] = min(entry['backoff'] * 2, MAX_BACKOFF)
+                entry['next_try'] = time() + entry['backoff']
+                if entry['attempts'] == REPORT_AFTER:
+                    print(ERROR + f'Janitor failed to delete {path} after {REPORT_AFTER} attempts, still retrying')
+                    print(ACTION + f'Resolution: Close whatever has these files open or delete them manually: {", ".join(remaining_files(path))}')
+        sleep(MIN_BACKOFF)
+
+
+def remaining_files(path):
+    files = []
+    for root, _, filenames in os.walk(path):
+        for name in filenames:
+            files.append(os.path.join(root, name))
+    return files or [path]
+
+
+def report():
+    # Paths still waiting to be deleted and how many times deleting them has failed
+    with lock:
+        return {path: entry['attempts'] for path, entry in pending.items()}
@@ -0,0 +1,195 @@
+import contextvars
+import json
+import os
+import shutil
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from time import sleep, time
+from colorama import Fore
+
+ERROR = f'{Fore.RED}[ERR]{Fore.RESET} '
+ACTION = f'{Fore.CYAN}[ACT]{Fore.RESET} '
+MIN_BACKOFF = 1
+MAX_BACKOFF = 300
+MAX_ATTEMPTS = 3  # Failures in a row before a job's file is moved to cache/failed
+FAILED_DIR = os.path.join('cache', 'failed')
+
+# Every league (tenant) gets its own cache/, data/ and rehosted_replays/ under its root and its own spreadsheet
+# Without a leagues.json the original single league layout in the current directory is used
+#
+# leagues.json looks like DEFAULT_CONFIG, only 'name' is required per league:
+# {"leagues": [{"name": "QCC 2024", "spreadsheet": "QCC 2024 Stats", "root": ".", "match_report_channel": 1228175751648509973},
+#              {"name": "QCC Summer", "spreadsheet": "QCC Summer Stats", "match_report_channel": 123, "guild": 456}]}
+# A league can also set "best_of" (default 3), the series length for live series submitted without 'live bo1'/'live bo3'
+CONFIG_FILE = 'leagues.json'
+DEFAULT_CONFIG = {
+    'bot_user_id': 1223654836189397002,
+    'max_workers': 4,
+    'leagues': [{
+        'name': 'QCC 2024',
+        'spreadsheet': 'QCC 2024 Stats',
+        'root': '.',
+        'match_report_channel': 1228175751648509973,
+        'guild': None,
+    }]
+}
+DIRS = [
+    os.path.join('cache', 'replay_buffer'),
+    os.path.join('cache', 'replay_cache'),
+    os.path.join('cache', 'write_cache'),
+    FAILED_DIR,
+    os.path.join('data', 'match_replays'),
+    'rehosted_replays',
+]
+
+config = None
+current_league = contextvars.ContextVar('current_league', default=None)  # Per thread and per asyncio task
+
+
+def load_config():
+    global config
+    if config is not None:
+        return config
+
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'r') as f:
+            loaded = json.load(f)
+    else:
+        loaded = DEFAULT_CONFIG
+
+    config = {**DEFAULT_CONFIG, **loaded}
+    for league in config['leagues']:
+        league.setdefault('spreadsheet', league['name'])
+        league.setdefault('root', os.path.join('leagues', league['name'].replace(' ', '_')))
+        league.setdefault('match_report_channel', None)
+        league.setdefault('guild', None)
+        for dir_ in DIRS:
+            os.makedirs(os.path.join(league['root'], dir_), exist_ok=True)
+    return config
+
+
+def all_leagues():
+    return load_config()['leagues']
+
+
+def get_league(name):
+    for league in all_leagues():
+        if league['name'] == name:
+            return league
+    raise KeyError(f'Unknown league {name}')
+
+
+def current():
+    return current_league.get() or all_leagues()[0]
+
+
+@contextmanager
+def use(league):
+    token = current_league.set(league)
+    try:
+        yield league
+    finally:
+        current_league.reset(token)
+
+
+def run_as(league, fn, *args):
+    # For work handed to another thread, which doesn't inherit the caller's league
+    with use(league):
+        return fn(*args)
+
+
+def path(*parts):
+    return os.path.join(current()['root'], *parts)
+
+
+def spreadsheet():
+    return current()['spreadsheet']
+
+
+def for_channel(channel_id, guild_id=None):
+    # A league's own report channel wins, then a league tied to the server, then the first league
+    leagues = all_leagues()
+    for league in leagues:
+        if league['match_report_channel'] == channel_id:
+            return league
+    for league in leagues:
+        if league['guild'] is not None and league['guild'] == guild_id:
+            return league
+    return leagues[0]
+
+
+def give_up(job_dir, job, error):
+    # Moves a file that keeps failing out of the way so the jobs behind it can run
+    failed = path(FAILED_DIR)
+    os.makedirs(failed, exist_ok=True)
+    target = os.path.join(failed, job)
+    if os.path.exists(target):
+        target = os.path.join(failed, f'{int(time() * 1000)}-{job}')
+    shutil.move(path(job_dir, job), target)
+    print(ERROR + f'{current()["name"]}: {job} failed {MAX_ATTEMPTS} times, moved it to {target}: {error!r}')
+    print(ACTION + f'Resolution: Fix or replace the file and move it back to {path(job_dir)}')
+
+
+def schedule(get_jobs, run_job, interval=1, job_dir=None):
+    # Leagues take turns submitting one job at a time, so a busy league can't starve the others
+    # and jobs within a league stay in order
+    # A job that fails is logged and its league backs off (1 second doubling up to 5 minutes) before retrying,
+    # the other leagues carry on. Jobs are filenames in job_dir, one that fails MAX_ATTEMPTS times in a row is
+    # moved to cache/failed so it can't hold up the rest of its league
+    leagues = all_leagues()
+    by_name = {league['name']: league for league in leagues}
+    max_workers = min(load_config()['max_workers'], len(leagues))
+    running = {}  # League name -> (job, future)
+    backoff = {}  # League name -> (seconds, retry at)
+    failures = {}  # League name -> (job, failures in a row)
+    turn = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            for name, (job, future) in list(running.items()):
+                if not future.done():
+                    continue
+                del running[name]
+                try:
+                    future.result()
+                    backoff.pop(name, None)
+                    failures.pop(name, None)
+                    continue
+                except Exception as e:
+                    error = e
+                traceback.print_exception(error)
+                failed_job, attempts = failures.get(name, (None, 0))
+                attempts = attempts + 1 if failed_job == job else 1
+                if job_dir is not None and attempts >= MAX_ATTEMPTS:
+                    backoff.pop(name, None)
+                    failures.pop(name, None)
+                    try:
+                        run_as(by_name[name], give_up, job_dir, job, error)
+                    except OSError as e:
+                        print(ERROR + f'{name}: could not move {job} out of the way: {e!r}')
+                    continue
+                failures[name] = (job, attempts)
+                seconds = min(backoff.get(name, (MIN_BACKOFF / 2, 0))[0] * 2, MAX_BACKOFF)
+                backoff[name] = (seconds, time() + seconds)
+                print(ERROR + f'{name}: {job} failed, retrying in {seconds:g} seconds: {error!r}')
+
+            order = leagues[turn:] + leagues[:turn]
+            turn = (turn + 1) % len(leagues)
+            for league in order:
+                if league['name'] in running or len(running) >= max_workers:
+                    continue
+                if league['name'] in backoff and backoff[league['name']][1] > time():
+                    continue
+                try:
+                    jobs = run_as(league, get_jobs)
+                except Exception as e:
+                    print(ERROR + f'{league["name"]}: could not list jobs: {e!r}')
+                    continue
+                if jobs:
+                    running[league['name']] = (jobs[0], executor.submit(run_as, league, run_job, jobs[0]))
+
+            # Come back as soon as any league finishes a job, otherwise poll for new files
+            if running:
+                wait([future for _, future in running.values()], timeout=interval, return_when=FIRST_COMPLETED)
+            else:
+                sleep(interval)
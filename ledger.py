@@ -0,0 +1,108 @@
+import json
+import os
+from time import time
+import leagues
+
+# Append-only record of how far each match got through the pipeline, shared by replay_parser and stats_manager
+# Stages in order: extracted (archive unzipped and saved), dissected, parsed (write_cache files written),
+# merged (a write_cache file folded into data/), published (that file's sheets updated)
+# Archives that stop early are marked rehosted or skipped instead
+# Archives are keyed by their archive store id rather than their filename, which isn't unique (Match.zip)
+# parsed is marked with the match's files before they are moved out of their .tmp names, so stats_manager never
+# sees a file the ledger doesn't know about and recover can finish moving them after a crash
+LEDGER_FILE = os.path.join('data', 'job_ledger.jsonl')
+STAGES = ['extracted', 'dissected', 'parsed', 'merged', 'published']
+
+states = {}  # League name -> state built from the ledger file
+
+
+def mark(stage, match_id=None, archive=None, file=None, files=None):
+    entry = {'time': time(), 'stage': stage, 'match_id': match_id}
+    if archive is not None:
+        entry['archive'] = archive
+    if file is not None:
+        entry['file'] = file
+    if files is not None:
+        entry['files'] = files
+
+    # fsync so a crash right after this returns can't lose the entry
+    with open(leagues.path(LEDGER_FILE), 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load():
+    # Only the lines added since the last call are read, the other process may have appended some
+    league = leagues.current()['name']
+    if league not in states:
+        states[league] = {'offset': 0, 'archives': {}, 'matches': {}, 'files': {}}
+    state = states[league]
+
+    ledger_file = leagues.path(LEDGER_FILE)
+    if not os.path.exists(ledger_file) or os.path.getsize(ledger_file) == state['offset']:
+        return state
+
+    with open(ledger_file, 'r') as f:
+        f.seek(state['offset'])
+        for line in f:
+            # A line cut short by a crash is ignored, it will be redone
+            if not line.endswith('\n'):
+                break
+            state['offset'] += len(line.encode('utf-8'))
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            apply(state, entry)
+    return state
+
+
+def apply(state, entry):
+    if 'archive' in entry:
+        state['archives'].setdefault(entry['archive'], set()).add(entry['stage'])
+
+    match_id = entry['match_id']
+    if match_id is None:
+        return
+    # A match only gets an id once its archive has been extracted and dissected
+    match = state['matches'].setdefault(match_id, {'files': [], 'stages': {'extracted': True}})
+    if 'files' in entry:
+        match['files'] = entry['files']
+        for file in entry['files']:
+            state['files'][file] = match_id
+    if 'file' in entry:
+        match['stages'].setdefault(entry['stage'], set()).add(entry['file'])
+    else:
+        match['stages'][entry['stage']] = True
+
+
+def unfinished_archives():
+    archives = load()['archives']
+    return [archive for archive, stages in archives.items() if 'extracted' in stages and not stages & {'parsed', 'rehosted', 'skipped'}]
+
+
+def match_for_file(file):
+    return load()['files'].get(file)
+
+
+def is_done(match_id, stage, file=None):
+    match = load()['matches'].get(match_id)
+    if match is None or stage not in match['stages']:
+        return False
+    done = match['stages'][stage]
+    if done is True:
+        return True
+    if file is not None:
+        return file in done
+    return set(match['files']) <= done
+
+
+def progress(match_id):
+    # Furthest stage this match has fully completed
+    reached = None
+    for stage in STAGES:
+        if not is_done(match_id, stage):
+            break
+        reached = stage
+    return reached
@@ -0,0 +1,87 @@
+import json
+import os
+import re
+from time import time
+import leagues
+
+# Series submitted one map at a time, as live-*.zip archives in the replay buffer (see replay_parser.parse_live_map)
+# Each map's player stats and round facts are written as soon as it is parsed, while the series' map results
+# are kept here. Its match log is written once a team has won the series, unless the full
+# archive arrives first, in which case the full archive's match log is used and the live series is closed
+# The series length comes with the submission ('live bo1' / 'live bo3' in the message, saved as live-bo1-<name>.zip)
+# since BO1 and BO3 matches are played side by side, the league's best_of is only the fallback
+STATE_FILE = os.path.join('data', 'live_series.json')
+LIVE_PREFIX = 'live-'
+BEST_OF_MESSAGE = re.compile(r'\bbo(\d+)\b', re.IGNORECASE)
+BEST_OF_NAME = re.compile(LIVE_PREFIX + r'bo(\d+)-')
+SERIES_GAP = 6 * 60 * 60  # Seconds between maps before the same two teams count as a new series
+DEFAULT_BEST_OF = 3
+
+
+def load():
+    state_file = leagues.path(STATE_FILE)
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, 'r') as f:
+        return json.load(f)
+
+
+def save(state):
+    state_file = leagues.path(STATE_FILE)
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(state_file + '.tmp', state_file)
+
+
+def default_best_of():
+    return leagues.current().get('best_of', DEFAULT_BEST_OF)
+
+
+def best_of_from_message(content):
+    match = BEST_OF_MESSAGE.search(content)
+    return int(match.group(1)) if match else default_best_of()
+
+
+def submission_name(filename, best_of):
+    return f'{LIVE_PREFIX}bo{best_of}-{filename}'
+
+
+def best_of_from_name(file):
+    match = BEST_OF_NAME.match(file)
+    return int(match.group(1)) if match else default_best_of()
+
+
+def wins_needed(series):
+    return series.get('best of', default_best_of()) // 2 + 1
+
+
+def find_series(state, teams, map_time):
+    for series_id, series in state.items():
+        if series['status'] != 'open' or set(teams) != {series['team'], series['opponent']}:
+            continue
+        if abs(map_time - max(map_['time'] for map_ in series['maps'])) <= SERIES_GAP:
+            return series_id
+    return None
+
+
+def open_series(state, series_id, team, opponent, best_of):
+    state[series_id] = {'team': team, 'opponent': opponent, 'best of': best_of, 'maps': [], 'map ids': [], 'status': 'open', 'updated': time()}
+    return state[series_id]
+
+
+def add_map(series, map_id, map_result):
+    # Returns True once a team has won enough maps to end the series
+    if map_id not in series['map ids']:
+        series['map ids'].append(map_id)
+        series['maps'].append(map_result)
+    series['updated'] = time()
+    maps_won = len([map_ for map_ in series['maps'] if map_['win']])
+    maps_lost = len(series['maps']) - maps_won
+    return max(maps_won, maps_lost) >= wins_needed(series)
+
+
+def series_for_maps(state, map_ids):
+    for series_id, series in state.items():
+        if set(series['map ids']) & set(map_ids):
+            return series_id
+    return None
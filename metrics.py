@@ -0,0 +1,155 @@
+import atexit
+import contextvars
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from time import sleep, time, perf_counter
+import leagues
+
+# Stage timings for replay_parser, stats_manager and the bot
+# Every span is appended to logs/spans.jsonl and rolled up into a Prometheus text file per process
+# Recording a span only touches memory, a background thread writes both files every FLUSH_INTERVAL seconds
+# (and once more at exit) so spans on the bot's event loop or around Sheets calls never wait on disk
+# LOG_DIR is fixed when the module is imported, the flush runs later from another thread or at exit and mustn't
+# follow a chdir. Tools working on synthetic data (benchmark.py, pipeline_harness.py) set ENABLED to False so their
+# spans never end up in the real files
+LOG_DIR = os.path.abspath('logs')
+SPANS_FILE = os.path.join(LOG_DIR, 'spans.jsonl')
+PROCESS = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+FLUSH_INTERVAL = 5
+ENABLED = True
+
+lock = threading.Lock()
+flush_lock = threading.Lock()
+current_stage = contextvars.ContextVar('current_stage', default=None)  # Per thread and per asyncio task
+counts = {}
+histograms = {}
+pending = []  # Span lines not yet written to spans.jsonl
+flusher = None
+
+
+@contextmanager
+def span(stage, **labels):
+    parent = current_stage.get()
+    token = current_stage.set(stage)
+
+    start = time()
+    start_perf = perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        duration = perf_counter() - start_perf
+        current_stage.reset(token)
+        record(stage, start, duration, status, parent, labels)
+
+
+def record(stage, start, duration, status, parent, labels):
+    global flusher
+    if not ENABLED:
+        return
+    league = leagues.current()['name']
+    line = json.dumps({
+        'time': start,
+        'process': PROCESS,
+        'league': league,
+        'stage': stage,
+        'parent': parent,
+        'duration': round(duration, 6),
+        'status': status,
+        **{key: str(value) for key, value in labels.items()}
+    })
+
+    with lock:
+        counts[(league, stage, status)] = counts.get((league, stage, status), 0) + 1
+        if (league, stage) not in histograms:
+            histograms[(league, stage)] = {'buckets': [0] * len(BUCKETS), 'sum': 0, 'count': 0}
+        histogram = histograms[(league, stage)]
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += duration
+        histogram['count'] += 1
+        pending.append(line)
+
+        if flusher is None:
+            flusher = threading.Thread(target=run, daemon=True)
+            flusher.start()
+
+
+def run():
+    while True:
+        sleep(FLUSH_INTERVAL)
+        flush()
+
+
+@atexit.register
+def flush():
+    # Only one flush writes at a time, spans recorded meanwhile wait for the next one
+    with flush_lock:
+        with lock:
+            if not pending and not counts:
+                return
+            lines = pending[:]
+            del pending[:]
+            prometheus = render()
+
+        os.makedirs(LOG_DIR, exist_ok=True)
+        if lines:
+            with open(SPANS_FILE, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+
+        # Written to a temp file and swapped in so a scrape never sees a half written file
+        prometheus_file = os.path.join(LOG_DIR, f'metrics-{PROCESS}.prom')
+        with open(prometheus_file + '.tmp', 'w') as f:
+            f.write(prometheus)
+        os.replace(prometheus_file + '.tmp', prometheus_file)
+
+
+def render():
+    process = f'process="{PROCESS}"'
+    lines = [
+        '# HELP qcc_stage_total Number of times each stage ran',
+        '# TYPE qcc_stage_total counter',
+    ]
+    for (league, stage, status), count in sorted(counts.items()):
+        lines.append(f'qcc_stage_total{{{process},league="{league}",stage="{stage}",status="{status}"}} {count}')
+
+    lines.append('# HELP qcc_stage_duration_seconds Time spent in each stage')
+    lines.append('# TYPE qcc_stage_duration_seconds histogram')
+    for (league, stage), histogram in sorted(histograms.items()):
+        labels = f'{process},league="{league}",stage="{stage}"'
+        for bound, count in zip(BUCKETS, histogram['buckets']):
+            lines.append(f'qcc_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'qcc_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+        lines.append(f'qcc_stage_duration_seconds_sum{{{labels}}} {histogram["sum"]:.6f}')
+        lines.append(f'qcc_stage_duration_seconds_count{{{labels}}} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class TracedWorksheet:
+    # Wraps a gspread worksheet so every API call gets its own span
+    def __init__(self, sheet):
+        self.sheet = sheet
+
+    def __getattr__(self, name):
+        attr = getattr(self.sheet, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with span(f'sheets.{name}', sheet=self.sheet.title):
+                return attr(*args, **kwargs)
+        return call
+
+
+def worksheet(client, spreadsheet, title):
+    with span('sheets.open', sheet=title):
+        sheet = client.open(spreadsheet).worksheet(title)
+    return TracedWorksheet(sheet)
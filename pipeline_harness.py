@@ -0,0 +1,292 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import zipfile
+from datetime import timedelta
+from time import sleep, time
+import pandas as pd
+from tabulate import tabulate
+import ledger
+import live_series
+import metrics
+import replay_parser
+import stats_manager
+import synthetic_data
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub_r6_dissect.py')
+DIRS = [
+    os.path.join('cache', 'replay_buffer'),
+    os.path.join('cache', 'replay_cache'),
+    os.path.join('cache', 'write_cache'),
+    os.path.join('data', 'match_replays'),
+    'rehosted_replays',
+]
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+def install_stub():
+    # ./r6-dissect is a tiny shell wrapper so replay_parser runs it exactly like the real binary
+    with open('r6-dissect', 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{STUB}" "$@"\n')
+    os.chmod('r6-dissect', os.stat('r6-dissect').st_mode | stat.S_IEXEC)
+
+
+def make_archive(roster, match_num, maps, rehost, seed, live=False):
+    # With live, each map is also submitted on its own first (live-bo<maps>-match-<num>-m<map>.zip), the full
+    # archive that follows must not count anything twice
+    teams = [row[0] for row in roster[1:]]
+    team_1, team_2 = random.Random(seed).sample(teams, 2)
+    start_time = synthetic_data.START_TIME + timedelta(days=match_num)
+    replay_jsons = synthetic_data.generate_series(roster, team_1, team_2, maps, rehost_map=0 if rehost else None, start_time=start_time, seed=seed)
+
+    # One folder per map with the canned dissect output and a placeholder .rec
+    archive = f'match-{match_num:04d}.zip'
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as z:
+        for map_num, replay_json in enumerate(replay_jsons):
+            folder = f'Match-{match_num:04d}-{map_num}'
+            z.writestr(f'{folder}/dissect.json', json.dumps(replay_json))
+            z.writestr(f'{folder}/R01.rec', os.urandom(1024))
+    live_archives = []
+    if live:
+        with zipfile.ZipFile(archive, 'r') as z:
+            for map_num, replay_json in enumerate(replay_jsons):
+                live_archive = live_series.submission_name(f'match-{match_num:04d}-m{map_num}.zip', maps)
+                with zipfile.ZipFile(live_archive, 'w', zipfile.ZIP_DEFLATED) as live_z:
+                    for name in z.namelist():
+                        if name.startswith(f'Match-{match_num:04d}-{map_num}/'):
+                            live_z.writestr(name, z.read(name))
+                live_archives.append(live_archive)
+    expected = set()
+    if not rehost:
+        map_ids = [replay_parser.get_match_id(replay_json) for replay_json in replay_jsons]
+        expected = {f'player_stats-{map_id}.csv' for map_id in map_ids}
+        expected |= {f'round_facts-{map_id}.parquet' for map_id in map_ids}
+        expected.add(('match_log', frozenset(map_ids)))
+    return archive, expected, live_archives
+
+
+class Crash(Exception):
+    # Stands in for the process dying right after a ledger entry is written
+    pass
+
+
+class Harness:
+    def __init__(self, archives, live=None, crash_fraction=0):
+        self.archives = archives
+        self.live = live or {}  # Archive -> its maps submitted live ahead of it
+        self.lock = threading.Lock()
+        self.arrived = {}
+        self.parse_start = {}
+        self.parse_end = {}
+        self.pending = {archive: set(expected) for archive, expected in archives}
+        self.file_owner = {item: archive for archive, expected in archives for item in expected if type(item) == str}
+        self.write_wait = []
+        self.write_time = []
+        self.done = {}
+        self.finished = threading.Event()
+        self.crashes = 0
+
+        # Every ledger entry has a crash_fraction chance of being the last thing the process does, the parser
+        # then restarts through replay_parser.recover and stats_manager picks the same file up again
+        if crash_fraction:
+            crash_rng = random.Random(1)
+            mark = ledger.mark
+
+            def crashing_mark(*args, **kwargs):
+                mark(*args, **kwargs)
+                with self.lock:
+                    crash = crash_rng.random() < crash_fraction
+                    self.crashes += crash
+                if crash:
+                    raise Crash(args[0])
+            ledger.mark = crashing_mark
+
+    def archive(self, file):
+        # Live maps and archives put back by recover (<name>-<archive id>.zip) count towards their match's archive
+        return re.search(r'match-\d{4}', file).group(0) + '.zip'
+
+    def owner(self, file):
+        # match_log files are named after whichever map r6-dissect listed first
+        if file in self.file_owner:
+            return self.file_owner[file], file
+        for archive, expected in self.pending.items():
+            for item in expected:
+                if type(item) == tuple and file.startswith('match_log-') and file[len('match_log-'):-len('.csv')] in item[1]:
+                    return archive, item
+        return None, None
+
+    def produce(self, rate):
+        for archive, _ in self.archives:
+            # Rename in so the parser never sees a half-written zip
+            with self.lock:
+                self.arrived[archive] = time()
+            for live_archive in self.live.get(archive, []):
+                os.rename(live_archive, os.path.join('cache', 'replay_buffer', live_archive))
+            os.rename(archive, os.path.join('cache', 'replay_buffer', archive))
+            if rate:
+                sleep(60 / rate)
+
+    def parse(self):
+        while not self.finished.is_set():
+            for file in sorted(os.listdir(os.path.join('cache', 'replay_buffer'))):
+                archive = self.archive(file)
+                self.parse_start.setdefault(archive, time())
+                try:
+                    replay_parser.parse_file(file)
+                except Crash:
+                    replay_parser.recover()
+                # A match is only done once its full archive has been through
+                if file.startswith(live_series.LIVE_PREFIX):
+                    continue
+                with self.lock:
+                    self.parse_end[archive] = time()
+                    if not self.pending[archive]:
+                        self.done[archive] = self.parse_end[archive]
+            sleep(0.05)
+
+    def write(self):
+        while len(self.done) < len(self.archives):
+            # Same pickup as stats_manager.main, which leaves out .tmp files and files the ledger doesn't know yet
+            for file in stats_manager.get_pending_files():
+                with self.lock:
+                    archive, item = self.owner(file)
+                start = time()
+                try:
+                    stats_manager.write_data(file)
+                except Crash:
+                    continue
+                end = time()
+                if archive is None:
+                    continue
+                with self.lock:
+                    self.write_wait.append(max(start - self.parse_end.get(archive, start), 0))
+                    self.write_time.append(end - start)
+                    self.pending[archive].discard(item)
+                    if not self.pending[archive] and archive in self.parse_end:
+                        self.done[archive] = end
+            sleep(0.05)
+        self.finished.set()
+
+    def check(self):
+        # Every match counted exactly once, whatever happened on the way
+        problems = []
+        maps = [item for _, expected in self.archives for item in expected if type(item) == str and item.startswith('player_stats-')]
+        series = [item for _, expected in self.archives for item in expected if type(item) == tuple]
+        match_log = pd.read_csv(os.path.join('data', 'match_log.csv')) if series else pd.DataFrame()
+        if len(match_log) != 2 * len(series):
+            problems.append(f'{len(match_log)} match log rows for {len(series)} matches')
+        raw = pd.read_csv(os.path.join('data', 'raw_player_stats.csv')) if maps else pd.DataFrame(columns=['match id', 'player'])
+        if raw.duplicated(['match id', 'player']).any():
+            problems.append(f'{raw.duplicated(["match id", "player"]).sum()} duplicate raw player stats rows')
+        if raw['match id'].nunique() != len(maps):
+            problems.append(f'{raw["match id"].nunique()} maps in raw player stats, expected {len(maps)}')
+        return problems
+
+    def report(self):
+        names = [archive for archive, _ in self.archives]
+        buffer_wait = [self.parse_start[a] - self.arrived[a] for a in names]
+        parse_time = [self.parse_end[a] - self.parse_start[a] for a in names]
+        end_to_end = [self.done[a] - self.arrived[a] for a in names]
+        elapsed = max(self.done.values()) - min(self.arrived.values())
+        stages = {
+            'replay_buffer wait': buffer_wait,
+            'parse_file': parse_time,
+            'write_cache wait': self.write_wait,
+            'write_data': self.write_time,
+            'end to end': end_to_end,
+        }
+        return {
+            'matches': len(names),
+            'crashes': self.crashes,
+            'problems': self.check(),
+            'elapsed_seconds': elapsed,
+            'matches_per_minute': len(names) / elapsed * 60,
+            'stages': {name: {'p50': percentile(values, 50), 'p99': percentile(values, 99), 'max': max(values, default=0)} for name, values in stages.items()},
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Push synthetic match archives through replay_parser and stats_manager')
+    parser.add_argument('-n', '--matches', type=int, default=10)
+    parser.add_argument('--maps', type=int, default=3, help='maps per match')
+    parser.add_argument('--rate', type=float, default=0, help='archives submitted per minute, 0 submits them all at once')
+    parser.add_argument('--rehost-fraction', type=float, default=0, help='fraction of archives that contain a rehost')
+    parser.add_argument('--dissect-delay', type=float, default=1.0, help='seconds the stub r6-dissect takes per map')
+    parser.add_argument('--sheets-latency', type=float, default=0.2, help='seconds each fake Sheets call takes')
+    parser.add_argument('--crash-fraction', type=float, default=0, help='chance of a simulated crash after each ledger entry')
+    parser.add_argument('--live-fraction', type=float, default=0, help='fraction of archives whose maps are also submitted live first')
+    parser.add_argument('--json', help='also write the report to this json file')
+    parser.add_argument('--verbose', action='store_true', help='show pipeline output')
+    args = parser.parse_args()
+
+    # Synthetic spans stay out of the real logs/
+    metrics.ENABLED = False
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='qcc-harness-')
+    os.chdir(workdir)
+    try:
+        for dir_ in DIRS:
+            os.makedirs(dir_)
+        install_stub()
+        os.environ['R6_DISSECT_DELAY'] = str(args.dissect_delay)
+
+        roster = synthetic_data.make_roster()
+        client = synthetic_data.FakeClient(roster, latency=args.sheets_latency)
+        replay_parser.client = client
+        stats_manager.client = client
+
+        rng = random.Random(0)
+        live_rng = random.Random(2)
+        archives, live = [], {}
+        for i in range(args.matches):
+            rehost = rng.random() < args.rehost_fraction
+            archive, expected, live_archives = make_archive(roster, i, args.maps, rehost, i, live=not rehost and live_rng.random() < args.live_fraction)
+            archives.append((archive, expected))
+            live[archive] = live_archives
+        harness = Harness(archives, live, args.crash_fraction)
+
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            threads = [
+                threading.Thread(target=harness.produce, args=(args.rate,)),
+                threading.Thread(target=harness.parse),
+                threading.Thread(target=harness.write),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        report = harness.report()
+        report['sheets_calls'] = client.calls()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    print(f'{report["matches"]} matches in {report["elapsed_seconds"]:.1f}s - {report["matches_per_minute"]:.2f} matches/min, {report["sheets_calls"]} Sheets calls, {report["crashes"]} crashes')
+    for problem in report['problems']:
+        print(f'PROBLEM: {problem}')
+    rows = [[name, f'{s["p50"]:.2f}', f'{s["p99"]:.2f}', f'{s["max"]:.2f}'] for name, s in report['stages'].items()]
+    print(tabulate(rows, headers=['Stage', 'p50 (s)', 'p99 (s)', 'Max (s)'], tablefmt='grid'))
+
+
+if __name__ == '__main__':
+    main()
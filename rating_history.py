@@ -0,0 +1,160 @@
+import bisect
+import json
+import os
+import leagues
+
+# Per player history of the cumulative stats in player_stats.csv, one point per map the player played
+# stats_manager appends a point for everyone in a map after folding it into raw_player_stats.csv
+# The file is append-only and read incrementally like the job ledger. It only holds each map's own counts, the
+# running totals and stats are worked out in memory from each player's points sorted by match time, so a map
+# processed after later ones (a late upload) just moves the totals of the points after it
+# "last N" is a slice and date ranges are a bisect instead of re-aggregating raw stats
+# The first append seeds the file from raw_player_stats.csv, so a league that started mid-season still has
+# cumulative values that match player_stats.csv. Rows from before maps carried a match id and time are folded
+# into one point per player at time 0
+HISTORY_FILE = os.path.join('data', 'rating_history.jsonl')
+RAW_STATS_FILE = os.path.join('data', 'raw_player_stats.csv')
+SEED_MATCH_ID = 'before history'
+STATS = ['Rating', 'K/D', 'KOST']
+COUNTS = ['kills', 'deaths', 'assists', 'rounds', 'kost rounds']
+
+states = {}  # League name -> {'offset', 'players': {player: {'times', 'points'}}, 'seen'}
+
+
+def load():
+    league = leagues.current()['name']
+    if league not in states:
+        states[league] = {'offset': 0, 'players': {}, 'seen': set()}
+    state = states[league]
+
+    history_file = leagues.path(HISTORY_FILE)
+    if not os.path.exists(history_file) or os.path.getsize(history_file) == state['offset']:
+        return state
+
+    with open(history_file, 'r') as f:
+        f.seek(state['offset'])
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            state['offset'] += len(line.encode('utf-8'))
+            try:
+                add(state, json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return state
+
+
+def stats(totals):
+    # Cumulative KOST, K/D and Rating from summed counts, also used by stats_manager.write_player_stats
+    # 0 where it would divide by zero rounds
+    if totals['rounds'] == 0:
+        return {stat: 0 for stat in STATS}
+    kpr = totals['kills'] / totals['rounds']
+    apr = totals['assists'] / totals['rounds']
+    srv = 1 - totals['deaths'] / totals['rounds']
+    return {
+        'Rating': 0.7937*kpr + 0.9091*apr + 0.9375*srv,
+        'K/D': totals['kills'] / totals['deaths'] if totals['deaths'] else totals['kills'],
+        'KOST': totals['kost rounds'] / totals['rounds'],
+    }
+
+
+def add(state, point):
+    key = (point['player'], point['match id'])
+    if key in state['seen']:
+        return
+    state['seen'].add(key)
+    history = state['players'].setdefault(point['player'], {'times': [], 'points': []})
+    # Maps nearly always arrive in order, so this is usually an append and only the new point's totals are worked out
+    i = bisect.bisect_right(history['times'], point['time'])
+    history['times'].insert(i, point['time'])
+    history['points'].insert(i, point)
+
+    totals = dict(history['points'][i - 1]['totals']) if i else {count: 0 for count in COUNTS}
+    for later in history['points'][i:]:
+        for count in COUNTS:
+            totals[count] += later[count]
+        later['totals'] = dict(totals)
+        later.update(stats(totals))
+
+
+def points(df, seen=()):
+    # One point per player per map in a raw player stats table, rows without a match id or time become the seed
+    lines = []
+    df = df.copy()
+    if 'match id' not in df.columns or 'time' not in df.columns:
+        df['match id'], df['time'] = None, None
+    undated = df['match id'].isna() | df['time'].isna()
+    df.loc[undated, 'match id'] = SEED_MATCH_ID
+    df.loc[undated, 'time'] = 0
+    for (player, match_id), rows in df.groupby(['player', 'match id']):
+        if (player, match_id) in seen:
+            continue
+        point = {'player': player, 'team': rows['team'].values[0], 'match id': match_id, 'time': float(rows['time'].values[0])}
+        for count in COUNTS:
+            point[count] = int(rows[count].sum())
+        lines.append(json.dumps(point) + '\n')
+    return lines
+
+
+def seed():
+    import pandas as pd
+    history_file = leagues.path(HISTORY_FILE)
+    lines = points(pd.read_csv(leagues.path(RAW_STATS_FILE))) if os.path.exists(leagues.path(RAW_STATS_FILE)) else []
+    with open(history_file + '.tmp', 'w') as f:
+        f.write(''.join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(history_file + '.tmp', history_file)
+
+
+def append(update_df):
+    # update_df is one map's player stats from the write_cache, one row per player
+    if not os.path.exists(leagues.path(HISTORY_FILE)):
+        seed()
+    state = load()
+    lines = points(update_df, state['seen'])
+    if not lines:
+        return
+
+    with open(leagues.path(HISTORY_FILE), 'a') as f:
+        f.write(''.join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+    load()
+
+
+def history(player):
+    return load()['players'].get(player, {'times': [], 'points': []})
+
+
+def last(player, n=5):
+    return history(player)['points'][-n:]
+
+
+def between(player, start=None, end=None):
+    # Points with start <= time <= end, times are unix timestamps
+    player_history = history(player)
+    lo = 0 if start is None else bisect.bisect_left(player_history['times'], start)
+    hi = len(player_history['times']) if end is None else bisect.bisect_right(player_history['times'], end)
+    return player_history['points'][lo:hi]
+
+
+def as_of(player, time_):
+    # Cumulative stats as they stood at a point in time (by match time), None before the player's first map
+    player_history = history(player)
+    i = bisect.bisect_right(player_history['times'], time_)
+    return player_history['points'][i - 1] if i else None
+
+
+def trend(player, stat='Rating', n=5):
+    # Change in a cumulative stat over the player's last n maps
+    points = history(player)['points']
+    if not points:
+        return 0
+    return points[-1][stat] - points[max(len(points) - n - 1, 0)][stat]
+
+
+def form(player, stat='Rating', n=5):
+    # Per map value of a stat over the last n maps, from each map's own counts
+    return [stats(point)[stat] for point in history(player)['points'][-n:]]
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import threading
+from time import sleep, time
+from colorama import Fore
+import metrics
+import leagues
+
+WARN = f'{Fore.YELLOW}[WRN]{Fore.RESET} '
+
+# Local copy of the sheets every stage looks things up in, one file per league shared by all processes
+# The snapshot's version is a hash of its contents, so every process agrees on which data it is using
+# It is refreshed in the background every REFRESH_INTERVAL seconds (see start) and on demand when a lookup misses,
+# at most once every REFRESH_COOLDOWN seconds, so fixing a name on the sheet no longer needs a restart
+SNAPSHOT_FILE = os.path.join('data', 'reference_data.json')
+SHEETS = ['!Roster List', '!Filters']
+REFRESH_INTERVAL = 300
+REFRESH_COOLDOWN = 60
+
+lock = threading.RLock()
+snapshots = {}  # League name -> (mtime, snapshot)
+
+
+def fetch(client):
+    sheets = {}
+    for title in SHEETS:
+        sheets[title] = metrics.worksheet(client, leagues.spreadsheet(), title).get_all_values()
+    version = hashlib.sha1(json.dumps(sheets, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    return {'version': version, 'fetched': time(), 'sheets': sheets}
+
+
+def refresh(client):
+    # Returns True if the sheets changed since the last snapshot
+    with lock, metrics.span('refresh_reference_data'):
+        snapshot = fetch(client)
+        old = load()
+        changed = old is None or old['version'] != snapshot['version']
+
+        snapshot_file = leagues.path(SNAPSHOT_FILE)
+        with open(snapshot_file + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(snapshot_file + '.tmp', snapshot_file)
+        snapshots[leagues.current()['name']] = (os.path.getmtime(snapshot_file), snapshot)
+        return changed
+
+
+def refresh_if_stale(client, max_age=None):
+    if max_age is None:
+        max_age = REFRESH_COOLDOWN
+    with lock:
+        snapshot = load()
+        if snapshot is not None and time() - snapshot['fetched'] < max_age:
+            return False
+        return refresh(client)
+
+
+def load():
+    # Picks up snapshots written by other processes, None if there isn't one yet
+    league = leagues.current()['name']
+    snapshot_file = leagues.path(SNAPSHOT_FILE)
+    if not os.path.exists(snapshot_file):
+        return None
+    mtime = os.path.getmtime(snapshot_file)
+    cached_mtime, snapshot = snapshots.get(league, (None, None))
+    if mtime != cached_mtime:
+        with open(snapshot_file, 'r') as f:
+            snapshot = json.load(f)
+        snapshots[league] = (mtime, snapshot)
+    return snapshot
+
+
+def get(client):
+    with lock:
+        snapshot = load()
+        if snapshot is None:
+            refresh(client)
+            snapshot = load()
+        return snapshot
+
+
+def values(client, title):
+    # Same as worksheet.get_all_values(), header row first
+    return get(client)['sheets'][title]
+
+
+def records(client, title):
+    # Same as worksheet.get_all_records(), except values are left as strings
+    rows = values(client, title)
+    return [dict(zip(rows[0], row)) for row in rows[1:]]
+
+
+def version(client):
+    return get(client)['version']
+
+
+def clear():
+    with lock:
+        snapshots.clear()
+
+
+def run(client, interval):
+    while True:
+        sleep(interval)
+        for league in leagues.all_leagues():
+            try:
+                leagues.run_as(league, refresh, client)
+            except Exception as e:
+                print(WARN + f'Reference data refresh failed for {league["name"]}, keeping the last snapshot: {e}')
+
+
+def start(client, interval=None):
+    if interval is None:
+        interval = REFRESH_INTERVAL
+    thread = threading.Thread(target=run, args=(client, interval), daemon=True)
+    thread.start()
+    return thread
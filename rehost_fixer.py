@@ -1,12 +1,19 @@
 import json
 import subprocess
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from fuzzywuzzy import fuzz
 from tabulate import tabulate
+import metrics
+import leagues
+import reference_data
 
-roster_sheet = None
+DISSECT_CACHE = os.path.join('cache', 'dissect_cache')
+REPORT_FILE = os.path.join('cache', 'rehost_report.json')
+MAX_WORKERS = 4
 
 
 def auth(file_name='client_key.json'):
@@ -21,12 +28,13 @@ def auth(file_name='client_key.json'):
     client = gspread.authorize(creds)
 
 
-def get_players_team(player_name):
-    global roster_sheet
+def load_roster():
     # Get roster sheet
-    if roster_sheet is None:
-        sheet = client.open('QCC 2024 Stats').worksheet('!Roster List')
-        roster_sheet = sheet.get_all_records()
+    return reference_data.records(client, '!Roster List')
+
+
+def get_players_team(player_name):
+    roster_sheet = load_roster()
 
     player_team_map = {}
     for r in range(len(roster_sheet)):
@@ -50,52 +58,166 @@ def get_players_team(player_name):
     return player_team_map[best_match]
 
 
-def main():
-    auth()
-
+def fingerprint(replay_dir):
+    # Every file's path, size and mtime, so a .rec replaced or overwritten in place is noticed
+    files = []
+    for root, _, filenames in os.walk(replay_dir):
+        for name in filenames:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files.append([os.path.relpath(path, replay_dir), stat.st_size, stat.st_mtime_ns])
+    return sorted(files)
+
+
+def dissect(match_folder, folder):
+    replay_dir = leagues.path('rehosted_replays', match_folder, folder)
+    cache_file = leagues.path(DISSECT_CACHE, match_folder, folder + '.json')
+    replay_fingerprint = fingerprint(replay_dir)
+
+    # Reuse output from a previous run if the replay hasn't changed since
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        if cached.get('fingerprint') == replay_fingerprint:
+            print(f'Reusing r6-dissect output for {match_folder}/{folder}')
+            return cached['output']
+
+    print(f'Running r6-dissect on {match_folder}/{folder}')
+    with metrics.span('dissect', folder=f'{match_folder}/{folder}'):
+        result = subprocess.run(['./r6-dissect', replay_dir], capture_output=True)
+
+    # Only output that parses is cached, a failed run is retried next time
+    try:
+        output = json.loads(result.stdout.decode('utf-8'))
+        if not output['rounds']:
+            raise ValueError('no rounds')
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f'r6-dissect failed on {folder} ({e}): {result.stderr.decode("utf-8", "replace").strip()[:200]}')
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump({'fingerprint': replay_fingerprint, 'output': output}, f)
+    os.replace(cache_file + '.tmp', cache_file)
+    return output
+
+
+def get_map_rounds(data):
+    team_0, team_1 = '', ''
+    for player in data['rounds'][0]['players']:
+        if team_0 == '' and player['teamIndex'] == 0:
+            team_0 = get_players_team(player['username'])
+        elif team_1 == '' and player['teamIndex'] == 1:
+            team_1 = get_players_team(player['username'])
+
+    round_data = []
+    for round_ in data['rounds']:
+        round_num = round_['roundNumber']
+
+        # Sides
+        attacking_team_idx = 0 if round_['teams'][0]['role'] == 'Attack' else 1
+        defending_team_idx = 1 if attacking_team_idx == 0 else 0
+        attacking_team = team_0 if attacking_team_idx == 0 else team_1
+        defending_team = team_0 if attacking_team_idx == 1 else team_1
+
+        # Scores
+        atk_score = round_['teams'][attacking_team_idx]['score']
+        def_score = round_['teams'][defending_team_idx]['score']
+
+        # Site
+        site = 'N/A'
+        if 'site' in round_.keys():
+            site = round_['site']
+
+        round_data.append([round_num, attacking_team, atk_score, defending_team, def_score, site])
+    return round_data
+
+
+def submit_dissects(match_folder, executor):
+    folders = sorted(os.listdir(leagues.path('rehosted_replays', match_folder)))
+    futures = [executor.submit(leagues.run_as, leagues.current(), dissect, match_folder, folder) for folder in folders]
+    return match_folder, folders, futures
+
+
+def build_match_report(match_folder, folders, futures):
+    # A match that can't be dissected is reported with its error instead of stopping the rest
+    try:
+        replay_jsons = [future.result() for future in futures]
+
+        maps = []
+        for map_num, (folder, data) in enumerate(zip(folders, replay_jsons)):
+            maps.append({
+                'map_num': map_num,
+                'folder': folder,
+                'map': data['rounds'][0]['map']['name'],
+                'rounds': get_map_rounds(data)
+            })
+    except Exception as e:
+        print(f'Could not report on {match_folder}: {e}')
+        return {'league': leagues.current()['name'], 'match': match_folder, 'maps': [], 'error': str(e)}
+    return {'league': leagues.current()['name'], 'match': match_folder, 'maps': maps}
+
+
+def batch():
+    # Dissect every map of every pending rehost in every league in one pool
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        jobs = []
+        for league in leagues.all_leagues():
+            with leagues.use(league):
+                rehosted_replays = leagues.path('rehosted_replays')
+                match_folders = sorted(folder for folder in os.listdir(rehosted_replays) if os.path.isdir(os.path.join(rehosted_replays, folder)))
+                print(f'Found {len(match_folders)} rehosted matches for {league["name"]}')
+                jobs += [(league, submit_dissects(match_folder, executor)) for match_folder in match_folders]
+        reports = [leagues.run_as(league, build_match_report, *job) for league, job in jobs]
+
+    # Machine readable report, one per league
+    for league in leagues.all_leagues():
+        with leagues.use(league):
+            report_file = leagues.path(REPORT_FILE)
+            with open(report_file, 'w') as f:
+                json.dump([report for report in reports if report['league'] == league['name']], f, indent=4)
+            print(f'Wrote report to {report_file}')
+
+    # Table report
+    headers = ['League', 'Match', 'Map #', 'Map', 'Round', 'ATK', 'ATK Score', 'DEF', 'DEF Score', 'Site']
+    rows = []
+    for report in reports:
+        if 'error' in report:
+            rows.append([report['league'], report['match'], '', 'ERROR', report['error'], '', '', '', '', ''])
+        for map_ in report['maps']:
+            for round_ in map_['rounds']:
+                rows.append([report['league'], report['match'], map_['map_num'], map_['map']] + round_)
+    print(tabulate(rows, headers=headers, tablefmt='grid'))
+
+
+def show_match():
     # If file in rehosted_replays folder
-    match_folder = os.listdir('rehosted_replays')[0]
+    match_folder = os.listdir(leagues.path('rehosted_replays'))[0]
     print(f'Found {match_folder}')
 
-    # Get match jsons
-    replay_jsons = []
-    for folder in os.listdir(f'rehosted_replays/{match_folder}'):
-        print(f'Running r6-dissect on {folder}')
-        replay_jsons.append(json.loads(subprocess.run(['./r6-dissect', f'rehosted_replays/{match_folder}/{folder}'], capture_output=True).stdout.decode('utf-8')))
-
     # Print round by round info
-    for map_num, data in enumerate(replay_jsons):
-        team_0, team_1 = '', ''
-        for player in data['rounds'][0]['players']:
-            if team_0 == '' and player['teamIndex'] == 0:
-                team_0 = get_players_team(player['username'])
-            elif team_1 == '' and player['teamIndex'] == 1:
-                team_1 = get_players_team(player['username'])
-
-        map_ = data['rounds'][0]['map']['name']
-        print(f'\nMap {map_num}: {map_}')
-        round_data = []
-        headers = ['Round', 'ATK', 'ATK Score', 'DEF', 'DEF Score', 'Site']
-        for round_ in data['rounds']:
-            round_num = round_['roundNumber']
-
-            # Sides
-            attacking_team_idx = 0 if round_['teams'][0]['role'] == 'Attack' else 1
-            defending_team_idx = 1 if attacking_team_idx == 0 else 0
-            attacking_team = team_0 if attacking_team_idx == 0 else team_1
-            defending_team = team_0 if attacking_team_idx == 1 else team_1
-
-            # Scores
-            atk_score = round_['teams'][attacking_team_idx]['score']
-            def_score = round_['teams'][defending_team_idx]['score']
-
-            # Site
-            site = 'N/A'
-            if 'site' in round_.keys():
-                site = round_['site']
-
-            round_data.append([round_num, attacking_team, atk_score, defending_team, def_score, site])
-        print(tabulate(round_data, headers=headers, tablefmt='grid'))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        report = build_match_report(*submit_dissects(match_folder, executor))
+    if 'error' in report:
+        return
+    headers = ['Round', 'ATK', 'ATK Score', 'DEF', 'DEF Score', 'Site']
+    for map_ in report['maps']:
+        print(f'\nMap {map_["map_num"]}: {map_["map"]}')
+        print(tabulate(map_['rounds'], headers=headers, tablefmt='grid'))
+
+
+def main():
+    auth()
+
+    if '--batch' in sys.argv:
+        batch()
+        return
+
+    # Single match mode works on one league, the first unless --league <name> is given
+    if '--league' in sys.argv:
+        league = leagues.get_league(sys.argv[sys.argv.index('--league') + 1])
+    else:
+        league = leagues.all_leagues()[0]
+    with leagues.use(league):
+        show_match()
 
 
 if __name__ == '__main__':
@@ -5,11 +5,19 @@ import zipfile
 import json
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-from time import sleep, time
 from datetime import datetime
+from time import time
+from collections import Counter
 from colorama import Fore
 from fuzzywuzzy import fuzz
 import shutil
+import metrics
+import leagues
+import ledger
+import janitor
+import archive_store
+import live_series
+import reference_data
 
 INFO = f'{Fore.GREEN}[INF]{Fore.RESET} '
 WARN = f'{Fore.YELLOW}[WRN]{Fore.RESET} '
@@ -17,7 +25,7 @@ ERROR = f'{Fore.RED}[ERR]{Fore.RESET} '
 ACTION = f'{Fore.CYAN}[ACT]{Fore.RESET} '
 
 client = None
-roster_sheet = None
+TRADE_WINDOW = 3  # Seconds
 
 
 def auth(file_name='client_key.json'):
@@ -34,13 +42,9 @@ def auth(file_name='client_key.json'):
     print('Done')
 
 
-def get_players_team(player_name):
-    global roster_sheet
-
+def get_players_team(player_name, retry=True):
     # Get roster sheet
-    if roster_sheet is None:
-        sheet = client.open('QCC 2024 Stats').worksheet('!Roster List')
-        roster_sheet = sheet.get_all_records()
+    roster_sheet = reference_data.records(client, '!Roster List')
 
     player_team_map = {}
     for r in range(len(roster_sheet)):
@@ -62,6 +66,9 @@ def get_players_team(player_name):
             best_match = player
 
     if best_match != player_name:
+        # The sheet may have been fixed since the last refresh
+        if retry and reference_data.refresh_if_stale(client):
+            return get_players_team(player_name, retry=False)
         found = False
         for r in range(len(roster_sheet)):
             for c in range(1, 9):
@@ -73,38 +80,109 @@ def get_players_team(player_name):
         row = r + 2
         col = chr(c + 65)
         print(WARN + f'       {player_name} is marked as {best_match} in the roster list sheet')
-        print(ACTION + f'       Resolution: Update "{best_match}" on the sheet \'!Roster List\'!{col}{row} to "{player_name}" (RELOAD CODE!)')
+        print(ACTION + f'       Resolution: Update "{best_match}" on the sheet \'!Roster List\'!{col}{row} to "{player_name}" (picked up within {reference_data.REFRESH_COOLDOWN} seconds, no restart needed)')
 
     return player_team_map[best_match]
 
 
 def parse_file(file):
+    with metrics.span('parse_file', file=file):
+        if file.startswith(live_series.LIVE_PREFIX):
+            _parse_live_map(file)
+        else:
+            _parse_file(file)
+
+    # Folders the janitor is still trying to delete, so a stuck one doesn't go unnoticed
+    waiting = janitor.report()
+    if waiting:
+        print(WARN + f'{len(waiting)} replay folder(s) waiting to be deleted: ' + ', '.join(f'{path} ({attempts} failed attempts)' for path, attempts in waiting.items()))
+
+
+def new_job_cache(file):
+    # Every attempt gets its own folder, so a folder the janitor hasn't cleared yet (or couldn't even move aside)
+    # never mixes into the next archive with the same name
+    return leagues.path('cache', 'replay_cache', f'{os.path.splitext(file)[0]}-{int(time() * 1000)}')
+
+
+def extract_archive(file, job_cache):
+    # Returns the archive's id in the archive store, which is what the ledger knows it by
+    replay_buffer = leagues.path('cache', 'replay_buffer')
+
     # === Unzip file in replay_buffer to replay_cache ===
     while True:
         try:
             if file.endswith('.zip'):
                 # Unzip to 'replay_cache' directory
                 print(INFO + f'New file detected - {file}')
-                with zipfile.ZipFile('cache/replay_buffer/' + file, 'r') as z:
-                    z.extractall('cache/replay_cache')
+                with metrics.span('unzip', file=file), zipfile.ZipFile(os.path.join(replay_buffer, file), 'r') as z:
+                    z.extractall(job_cache)
                 print(INFO + f'   Extracted {file} to replay_cache')
-                # Save zip to data/match_replays
-                if not os.path.exists('data/match_replays/' + file):
-                    print(INFO + f'   Saving {file} to match_replays')
-                    os.rename('cache/replay_buffer/' + file, 'data/match_replays/' + file)
+                # Save zip to the archive store
+                archive_id, existed = archive_store.store(os.path.join(replay_buffer, file), file)
+                if not existed:
+                    print(INFO + f'   Saved {file} to the archive store as {archive_id[:12]}')
                 else:
-                    print(WARN + f'   File already exists in match_replays: {file}')
-                    os.remove('cache/replay_buffer/' + file)
-                break
+                    print(WARN + f'   Archive already exists in the archive store: {file}')
+                # In the ledger before the zip leaves the buffer, so a crash in between can't lose the submission
+                ledger.mark('extracted', archive=archive_id)
+                os.remove(os.path.join(replay_buffer, file))
+                return archive_id
         except PermissionError:
             pass
 
+
+def dissect_all(job_cache):
     # === Run r6-dissect on extracted replay ===
     # For folder in match_dir, run r6-dissect
+    # In play order (folders are named after when the map started), rehost detection compares neighbouring maps
     replay_jsons = []
-    for folder in os.listdir('cache/replay_cache'):
+    for folder in sorted(os.listdir(job_cache)):
         print(INFO + f'   Running r6-dissect on {folder}')
-        replay_jsons.append(json.loads(subprocess.run(['./r6-dissect', 'cache/replay_cache/' + folder], capture_output=True).stdout.decode('utf-8')))
+        with metrics.span('dissect', folder=folder):
+            replay_jsons.append(json.loads(subprocess.run(['./r6-dissect', os.path.join(job_cache, folder)], capture_output=True).stdout.decode('utf-8')))
+    return replay_jsons
+
+
+def write_map_files(replay_json, write_cache):
+    # Player stats and round facts for one map, returns the files written
+    # Files are left under their .tmp names until move_files, so stats_manager never reads half of one
+    # Teams (a fuzzy roster lookup per player) and round timelines are worked out once and shared by both
+    player_teams = get_match_teams(replay_json)
+    timelines = [round_timeline(round_) for round_ in replay_json['rounds']]
+    with metrics.span('parse_player_stats', map=replay_json['rounds'][0]['map']['name']):
+        match_id, player_df = parse_json_player_stats(replay_json, player_teams, timelines)
+    player_df['match id'] = match_id
+    player_df['time'] = pd.to_datetime(replay_json['rounds'][0]['timestamp'].replace('T', ' ').replace('Z', '')).timestamp()
+    with metrics.span('write_csv', file=f'player_stats-{match_id}.csv'):
+        player_df.to_csv(os.path.join(write_cache, f'player_stats-{match_id}.csv.tmp'), index=False)
+
+    with metrics.span('parse_round_facts', map=replay_json['rounds'][0]['map']['name']):
+        match_id, facts_df = parse_json_round_facts(replay_json, player_teams, timelines)
+    with metrics.span('write_parquet', file=f'round_facts-{match_id}.parquet'):
+        facts_df.to_parquet(os.path.join(write_cache, f'round_facts-{match_id}.parquet.tmp'), index=False)
+    return [f'player_stats-{match_id}.csv', f'round_facts-{match_id}.parquet']
+
+
+def move_files(write_cache, files):
+    # Only called once the files are in the ledger
+    for file in files:
+        os.replace(os.path.join(write_cache, file + '.tmp'), os.path.join(write_cache, file))
+
+
+def map_ingested(map_id, series_id=None):
+    # True if this map's stats were already written by a live submission or another archive
+    owner = ledger.match_for_file(f'player_stats-{map_id}.csv')
+    return owner is not None and owner != series_id
+
+
+def _parse_file(file):
+    replay_buffer = leagues.path('cache', 'replay_buffer')
+    write_cache = leagues.path('cache', 'write_cache')
+    rehosted_replays = leagues.path('rehosted_replays')
+    job_cache = new_job_cache(file)
+
+    archive_id = extract_archive(file, job_cache)
+    replay_jsons = dissect_all(job_cache)
 
     # === Check for rehost ===
     # If the same map is played in two consecutive replays, rehost detected
@@ -113,66 +191,204 @@ def parse_file(file):
         team_2 = get_players_team(replay_jsons[0]['stats'][-1]['username']).replace(' ', '_')
         time_ = replay_jsons[0]['rounds'][0]['timestamp'].replace(':', '-')
         match_name = f'{team_1}-vs-{team_2}-{time_}'
-        print(ERROR + f'   Rehost detected on {folder}. Moved to ./rehosted_replays')
-        print(ACTION + f'   Resolution: Manually combine the replays in ./rehosted_replays/{folder}. Zip the resulting folder and move it to ./replay_buffer')
-        os.mkdir('rehosted_replays/' + match_name)
-        for folder in os.listdir('cache/replay_cache'):
-            shutil.move('cache/replay_cache/' + folder, 'rehosted_replays/' + match_name + '/' + folder)
-        os.remove('data/match_replays/' + file)
+        print(ERROR + f'   Rehost detected on {file}. Moved to {rehosted_replays}')
+        print(ACTION + f'   Resolution: Manually combine the replays in {os.path.join(rehosted_replays, match_name)}. Zip the resulting folder and move it to {replay_buffer}')
+        os.mkdir(os.path.join(rehosted_replays, match_name))
+        for folder in os.listdir(job_cache):
+            shutil.move(os.path.join(job_cache, folder), os.path.join(rehosted_replays, match_name, folder))
+        archive_store.forget(file, archive_id)
+        ledger.mark('rehosted', archive=archive_id)
+        archive_store.compact_later(archive_id)
+        with metrics.span('clean_replay_cache'):
+            clean_replay_cache(job_cache)
         return
 
+    # === Check the ledger ===
+    # A match that was already parsed (resubmitted, possibly under another name) is never counted twice
+    series_id = get_match_id(replay_jsons[0])
+    if ledger.is_done(series_id, 'parsed'):
+        print(WARN + f'   Match {series_id} was already processed (furthest stage: {ledger.progress(series_id)}), skipping {file}')
+        ledger.mark('skipped', series_id, archive=archive_id)
+        archive_store.compact_later(archive_id)
+        with metrics.span('clean_replay_cache'):
+            clean_replay_cache(job_cache)
+        return
+    ledger.mark('dissected', series_id, archive=archive_id)
+    archive_store.link_matches([get_match_id(replay_json) for replay_json in replay_jsons if replay_json], archive_id)
+
     # === Generate stats dataframes from r6-dissect output ===
-    # Player Stats
-    print(INFO + '   Parsing player stats')
+    files = []
+
+    # Player Stats and Round Facts, except maps already submitted live
+    print(INFO + '   Parsing player stats and round facts')
     for replay_json in replay_jsons:
         # If replay_json is empty, skip it
         if not replay_json:
             continue
-        match_id, player_df = parse_json_player_stats(replay_json)
-        player_df.to_csv(f'cache/write_cache/player_stats-{match_id}.csv', index=False)
-
-    # Match Log
-    print(INFO + '   Parsing match log')
-    match_id, match_log_df = parse_json_match_log(replay_jsons)
-    match_log_df.to_csv(f'cache/write_cache/match_log-{match_id}.csv', index=False)
+        if map_ingested(get_match_id(replay_json), series_id):
+            print(WARN + f'   {replay_json["rounds"][0]["map"]["name"]} was already submitted live, skipping its stats')
+            continue
+        files += write_map_files(replay_json, write_cache)
+
+    # Match Log, unless a live series already wrote it
+    state = live_series.load()
+    live_id = live_series.series_for_maps(state, [get_match_id(replay_json) for replay_json in replay_jsons if replay_json])
+    if live_id is not None and state[live_id]['status'] == 'finalized':
+        print(WARN + '   The match log for this series was already written from its live maps')
+    else:
+        if live_id is not None:
+            # The full archive wins over a live series that never finished
+            state[live_id]['status'] = 'closed'
+            live_series.save(state)
+        print(INFO + '   Parsing match log')
+        with metrics.span('parse_match_log'):
+            match_id, match_log_df = parse_json_match_log(replay_jsons)
+        with metrics.span('write_csv', file=f'match_log-{match_id}.csv'):
+            match_log_df.to_csv(os.path.join(write_cache, f'match_log-{match_id}.csv.tmp'), index=False)
+        files.append(f'match_log-{match_id}.csv')
+    ledger.mark('parsed', series_id, archive=archive_id, files=files)
+    move_files(write_cache, files)
+    archive_store.compact_later(archive_id)
 
     # === Empty replay_cache folder ===
-    # Recursively delete all files, then delete all folders
-    time_start = time()
-    while True:
-        if time() - time_start > 10:
-            # Get list of all files and another list of all directories
-            files = []
-            dirs = []
-            for root, dirnames, filenames in os.walk(os.path.join('cache', 'replay_cache')):
-                for file in filenames:
-                    files.append(os.path.join(root, file))
-                for dir_ in dirnames:
-                    dirs.append(os.path.join(root, dir_))
-
-            # If files exist, require manual deletion
-            if len(files):
-                print(ERROR + 'Failed to empty replay_cache folder')
-                print(ACTION + f'Resolution: Delete the following files manually: {", ".join(files)}. Press [ENTER] when action is completed')
-                input()
-            else:
-                # If directories exist, warn that they should be deleted, but don't halt
-                print(WARN + f'Failed to delete empty replay cache directory')
-                print(ACTION + f'Resolution: Delete the following directories manually: {", ".join(dirs)}')
-                break
+    with metrics.span('clean_replay_cache'):
+        clean_replay_cache(job_cache)
 
-        try:
-            for root, dirs, files in os.walk(os.path.join('cache', 'replay_cache'), topdown=False):
-                for name in files:
-                    os.remove(os.path.join(root, name))
-                for name in dirs:
-                    os.rmdir(os.path.join(root, name))
-            break
-        except PermissionError:
-            pass
+
+def _parse_live_map(file):
+    # A single map of a series that is still being played, see live_series
+    write_cache = leagues.path('cache', 'write_cache')
+    job_cache = new_job_cache(file)
+
+    archive_id = extract_archive(file, job_cache)
+    replay_jsons = dissect_all(job_cache)
+
+    for replay_json in sorted([replay_json for replay_json in replay_jsons if replay_json], key=lambda replay_json: replay_json['rounds'][0]['timestamp']):
+        map_id = get_match_id(replay_json)
+        map_name = replay_json['rounds'][0]['map']['name']
+        if map_ingested(map_id):
+            print(WARN + f'   {map_name} ({map_id}) was already processed, skipping it')
+            continue
+
+        # Stats for the map go out straight away
+        # Its ledger id is kept apart from the full archive's, which is named after the series' first map
+        print(INFO + f'   Parsing live map {map_name}')
+        ledger_id = live_series.LIVE_PREFIX + map_id
+        ledger.mark('dissected', ledger_id, archive=archive_id)
+        archive_store.link_matches([map_id], archive_id)
+        files = write_map_files(replay_json, write_cache)
+
+        # Then the map is added to its series, whose match log is written once a team has won it
+        player_teams = get_match_teams(replay_json)
+        team = player_teams[replay_json['stats'][0]['username']]
+        opponent = player_teams[replay_json['stats'][-1]['username']]
+        state = live_series.load()
+        map_time = pd.to_datetime(replay_json['rounds'][0]['timestamp'].replace('T', ' ').replace('Z', '')).timestamp()
+        # A map redone after a crash is already in its series
+        series_id = live_series.series_for_maps(state, [map_id]) or live_series.find_series(state, [team, opponent], map_time)
+        if series_id is None:
+            series_id = map_id
+            live_series.open_series(state, series_id, team, opponent, live_series.best_of_from_name(file))
+        series = state[series_id]
+        finished = live_series.add_map(series, map_id, get_map_result(replay_json, series['team']))
+        # A closed series already has its match log from the full archive
+        if finished and series['status'] != 'closed':
+            match_log_df = build_match_log(series['team'], series['opponent'], series['maps'])
+            with metrics.span('write_csv', file=f'match_log-{series_id}.csv'):
+                match_log_df.to_csv(os.path.join(write_cache, f'match_log-{series_id}.csv.tmp'), index=False)
+            files.append(f'match_log-{series_id}.csv')
+            series['status'] = 'finalized'
+            print(INFO + f'   Series {series["team"]} vs {series["opponent"]} is over, writing its match log')
+        # Saved before the map counts as parsed, so a crash in between redoes the map instead of leaving it out of
+        # its series
+        live_series.save(state)
+        ledger.mark('parsed', ledger_id, files=files)
+        move_files(write_cache, files)
+
+    ledger.mark('parsed', archive=archive_id)
+    archive_store.compact_later(archive_id)
+    with metrics.span('clean_replay_cache'):
+        clean_replay_cache(job_cache)
+
+
+def recover():
+    # Nothing is being parsed yet, so every extracted folder is a leftover from before a restart
+    janitor.sweep()
+    for folder in os.listdir(leagues.path('cache', 'replay_cache')):
+        clean_replay_cache(leagues.path('cache', 'replay_cache', folder))
+
+    # Files the ledger has were parsed before a crash and only need moving into place, the rest are half written
+    # and their archive is redone below
+    write_cache = leagues.path('cache', 'write_cache')
+    for file in os.listdir(write_cache):
+        if not file.endswith('.tmp'):
+            continue
+        if ledger.match_for_file(file[:-len('.tmp')]) is not None:
+            os.replace(os.path.join(write_cache, file), os.path.join(write_cache, file[:-len('.tmp')]))
+        else:
+            os.remove(os.path.join(write_cache, file))
+
+    # Archives that were extracted but never finished parsing go back in the replay buffer to be redone
+    replay_buffer = leagues.path('cache', 'replay_buffer')
+    for archive in ledger.unfinished_archives():
+        manifest = archive_store.manifest(archive)
+        if manifest is None:
+            print(ERROR + f'Cannot resume {archive}, it is missing from the archive store')
+            continue
+        # The crash came before the original zip left the buffer, it is simply redone
+        original = os.path.join(replay_buffer, manifest['name'])
+        if os.path.exists(original) and archive_store.identify(original) == archive:
+            continue
+        # Named after its id as well, another archive with the same name may be waiting in the buffer
+        file = f'{os.path.splitext(manifest["name"])[0]}-{manifest["id"][:12]}.zip'
+        if os.path.exists(os.path.join(replay_buffer, file)):
+            continue
+        print(WARN + f'Resuming unfinished archive {manifest["name"]} as {file}')
+        archive_store.export(manifest['id'], leagues.path('cache', 'replay_buffer', file))
+
+
+def clean_replay_cache(job_cache):
+    # Never blocks, anything locked is quarantined and retried by the janitor
+    janitor.discard(job_cache)
 
 
 def parse_json_match_log(replay_jsons):
+    # Get team names
+    my_team = get_players_team(replay_jsons[0]['stats'][0]['username'])
+    opponent_team = get_players_team(replay_jsons[0]['stats'][-1]['username'])
+
+    # Get map names and scores
+    maps = [get_map_result(replay_json, my_team) for replay_json in replay_jsons]
+
+    match_id = get_match_id(replay_jsons[0])
+    return match_id, build_match_log(my_team, opponent_team, maps)
+
+
+def get_map_result(replay_json, my_team):
+    team_1_name = get_players_team(replay_json['rounds'][0]['players'][0]['username'])
+    team_idx = replay_json['rounds'][0]['players'][0]['teamIndex'] if team_1_name == my_team else replay_json['rounds'][0]['players'][-1]['teamIndex']
+    opponent_idx = 0 if team_idx == 1 else 1
+
+    score_for = 0
+    score_against = 0
+    for round_ in replay_json['rounds']:
+        if round_['teams'][team_idx]['score'] > score_for:
+            score_for = round_['teams'][team_idx]['score']
+        if round_['teams'][opponent_idx]['score'] > score_against:
+            score_against = round_['teams'][opponent_idx]['score']
+
+    map_ = {}
+    map_['name'] = replay_json['rounds'][-1]['map']['name']
+    time_string = replay_json['rounds'][0]['timestamp'].replace('T', ' ').replace('Z', '')
+    map_['time'] = pd.to_datetime(time_string).timestamp()
+    map_['score_for'] = score_for
+    map_['score_against'] = score_against
+    map_['win'] = True if map_['score_for'] > map_['score_against'] else False
+    return map_
+
+
+def build_match_log(my_team, opponent_team, maps):
+    # Both rows of the match log from each map's result, seen from my_team's side
     match_log_df = pd.DataFrame(columns=[
         'Time',
         'Team',
@@ -196,33 +412,6 @@ def parse_json_match_log(replay_jsons):
         'Playoff?'
     ])
 
-    # Get team names
-    my_team = get_players_team(replay_jsons[0]['stats'][0]['username'])
-    opponent_team = get_players_team(replay_jsons[0]['stats'][-1]['username'])
-
-    # Get map names and scores
-    maps = []
-    for replay_json in replay_jsons:
-        team_1_name = get_players_team(replay_json['rounds'][0]['players'][0]['username'])
-        team_idx = replay_json['rounds'][0]['players'][0]['teamIndex'] if team_1_name == my_team else replay_json['rounds'][0]['players'][-1]['teamIndex']
-        opponent_idx = 0 if team_idx == 1 else 1
-
-        score_for = 0
-        score_against = 0
-        for round_ in replay_json['rounds']:
-            if round_['teams'][team_idx]['score'] > score_for:
-                score_for = round_['teams'][team_idx]['score']
-            if round_['teams'][opponent_idx]['score'] > score_against:
-                score_against = round_['teams'][opponent_idx]['score']
-
-        map_ = {}
-        map_['name'] = replay_json['rounds'][-1]['map']['name']
-        time_string = replay_json['rounds'][0]['timestamp'].replace('T', ' ').replace('Z', '')
-        map_['time'] = pd.to_datetime(time_string).timestamp()
-        map_['score_for'] = score_for
-        map_['score_against'] = score_against
-        map_['win'] = True if map_['score_for'] > map_['score_against'] else False
-        maps.append(map_)
     maps = sorted(maps, key=lambda x: x['time'])
 
     # If less than 3 maps, add empty maps
@@ -284,11 +473,50 @@ def parse_json_match_log(replay_jsons):
         'Playoff?': True if maps_won + maps_lost > 1 else False
     }])], ignore_index=True)
 
-    match_id = replay_jsons[0]['rounds'][0]['recordingProfileID'] + str(replay_jsons[0]['rounds'][0]['additionalTags']) + replay_jsons[0]['rounds'][0]['timestamp'].replace('-', '').replace(':', '').replace('Z', '').replace('T', '')
-    return match_id, match_log_df
-
-
-def parse_json_player_stats(replay_json):
+    return match_log_df
+
+
+def get_match_teams(replay_json):
+    # Username -> team for everyone in the map, so the fuzzy roster match runs once per player
+    return {player['username']: get_players_team(player['username']) for player in replay_json['stats']}
+
+
+def team_of(player_teams, player):
+    # Anyone missing from the stats section (e.g. left early) is looked up and remembered
+    if player not in player_teams:
+        player_teams[player] = get_players_team(player)
+    return player_teams[player]
+
+
+def round_timeline(round_):
+    # Everything the combat stats need from a round's feed, in one pass over it in feed order
+    timeline = {'kills': [], 'trades': Counter(), 'objectives': Counter(), 'plants': set(), 'defuses': set(), 'suicides': Counter()}
+    recent_kills = {}  # Killer -> times of their kills so far this round
+    for event in round_['matchFeedback'] or []:
+        event_type = event['type']['name']
+        player = event['username']
+        if event_type == 'Kill':
+            target, time_ = event['target'], event['timeInSeconds']
+            # Trade counts if someone kills someone who just got a kill within 3 seconds
+            for kill_time in recent_kills.get(target, []):
+                if abs(time_ - kill_time) <= TRADE_WINDOW:
+                    timeline['trades'][player] += 1
+            recent_kills.setdefault(player, []).append(time_)
+            timeline['kills'].append((player, target, time_))
+        elif event_type == 'DefuserPlantComplete':
+            # Every plant counts, a defuse only if that player has no objective yet this round
+            timeline['objectives'][player] += 1
+            timeline['plants'].add(player)
+        elif event_type == 'DefuserDisableComplete':
+            if player not in timeline['objectives']:
+                timeline['objectives'][player] += 1
+            timeline['defuses'].add(player)
+        elif event_type == 'Death':
+            timeline['suicides'][player] += 1
+    return timeline
+
+
+def parse_json_player_stats(replay_json, player_teams=None, timelines=None):
     player_df = pd.DataFrame(columns=['player', 'team', 'opponent', 'map', 'kills', 'deaths', 'assists', 'headshots', 'objectives', 'trades', 'opening kill', 'opening death', '2ks', '3ks', '4ks', 'aces', 'rounds', 'kost rounds', 'suicides', 'teamkills', '1vX'])
 
     # Stats from json stats section
@@ -305,58 +533,39 @@ def parse_json_player_stats(replay_json):
             }])
         ], ignore_index=True)
 
-    # Player's teams
-    player_df['team'] = player_df['player'].apply(get_players_team)
+    # Player's teams, resolved once for the whole map
+    if player_teams is None:
+        player_teams = get_match_teams(replay_json)
+    player_df['team'] = player_df['player'].map(player_teams)
     player_df['opponent'] = list(player_df['team'])[::-1]
 
     # Map
     player_df['map'] = replay_json['rounds'][0]['map']['name']
 
+    # One pass over each round's feed, everything below works from these
+    if timelines is None:
+        timelines = [round_timeline(round_) for round_ in replay_json['rounds']]
+
     # Objective
-    player_df['objectives'] = 0
-    objective_log = []
-    for round_num, round_ in enumerate(replay_json['rounds']):
-        if round_['matchFeedback'] is None:  # Skip if no matchFeedback
-            continue
-        for event in round_['matchFeedback']:
-            if event['type']['name'] == 'DefuserPlantComplete' or event['type']['name'] == 'DefuserDisableComplete' and (round_num, event['username']) not in objective_log:
-                player = event['username']
-                player_df.loc[player_df['player'] == player, 'objectives'] += 1
-                objective_log.append((round_num, player))
+    objectives = Counter()
+    for timeline in timelines:
+        objectives.update(timeline['objectives'])
+    player_df['objectives'] = player_df['player'].map(objectives).fillna(0).astype(int)
 
     # Trades
-    player_df['trades'] = 0
-    kill_feed = []
-    for round_ in replay_json['rounds']:
-        round_kill_feed = []
-        if round_['matchFeedback'] is None:  # Skip if no matchFeedback
-            continue
-        for event in round_['matchFeedback']:
-            if event['type']['name'] == 'Kill':
-                killer = event['username']
-                killed = event['target']
-                time = event['timeInSeconds']
-                round_kill_feed.append((killer, killed, time))
-        kill_feed.append(round_kill_feed)
-
-    # Trade counts if someone kills someone who just got a kill within 3 seconds
-    trade_log = []
-    for round_num, round_kills in enumerate(kill_feed):
-        for i in range(len(round_kills)):
-            for j in range(i + 1, len(round_kills)):
-                if round_kills[i][0] == round_kills[j][1] and abs(round_kills[j][2] - round_kills[i][2]) <= 3:
-                    player_df.loc[player_df['player'] == round_kills[j][0], 'trades'] += 1
-                    trade_log.append((round_num, round_kills[j][0]))
+    trades = Counter()
+    for timeline in timelines:
+        trades.update(timeline['trades'])
+    player_df['trades'] = player_df['player'].map(trades).fillna(0).astype(int)
 
     # Opening kills/deaths
-    player_df['opening kill'] = 0
-    player_df['opening death'] = 0
-    for round_kills in kill_feed:
-        if len(round_kills):
-            opening_kill = round_kills[0][0]
-            opening_death = round_kills[0][1]
-            player_df.loc[player_df['player'] == opening_kill, 'opening kill'] += 1
-            player_df.loc[player_df['player'] == opening_death, 'opening death'] += 1
+    opening_kills, opening_deaths = Counter(), Counter()
+    for timeline in timelines:
+        if timeline['kills']:
+            opening_kills[timeline['kills'][0][0]] += 1
+            opening_deaths[timeline['kills'][0][1]] += 1
+    player_df['opening kill'] = player_df['player'].map(opening_kills).fillna(0).astype(int)
+    player_df['opening death'] = player_df['player'].map(opening_deaths).fillna(0).astype(int)
 
     # 2k, 3k, 4k, ace
     player_df['2ks'] = 0
@@ -375,41 +584,30 @@ def parse_json_player_stats(replay_json):
                 player_df.loc[player_df['player'] == player['username'], 'aces'] += 1
 
     # KOST rounds
-    player_df['kost rounds'] = 0
-    for round_num in range(len(replay_json['rounds'])):
-        for player in player_df['player'].values:
-            survived, got_kill, got_trade, did_objective = False, False, False, False
-            for player_stat in replay_json['rounds'][round_num]['stats']:
-                if player_stat['username'] == player:
-                    survived = not player_stat['died']
-                    got_kill = player_stat['kills'] > 0
-            for trade in trade_log:
-                if trade[0] == round_num and trade[1] == player:
-                    got_trade = True
-            if replay_json['rounds'][round_num]['matchFeedback'] is None:  # Skip if no matchFeedback
-                continue
-            for event in replay_json['rounds'][round_num]['matchFeedback']:
-                if event['username'] == player and event['type']['name'] == 'DefuserPlantComplete':
-                    did_objective = True
-            if survived or got_kill or got_trade or did_objective:
-                player_df.loc[player_df['player'] == player, 'kost rounds'] += 1
-
-    # Suicides
-    player_df['suicides'] = 0
-    for round_ in replay_json['rounds']:
+    kost_rounds = Counter()
+    for round_, timeline in zip(replay_json['rounds'], timelines):
         if round_['matchFeedback'] is None:  # Skip if no matchFeedback
             continue
-        for event in round_['matchFeedback']:
-            if event['type']['name'] == 'Death':
-                player_df.loc[player_df['player'] == event['username'], 'suicides'] += 1
+        kost = set(timeline['trades']) | timeline['plants']
+        for player_stat in round_['stats']:
+            if not player_stat['died'] or player_stat['kills'] > 0:
+                kost.add(player_stat['username'])
+        kost_rounds.update(kost)
+    player_df['kost rounds'] = player_df['player'].map(kost_rounds).fillna(0).astype(int)
+
+    # Suicides
+    suicides = Counter()
+    for timeline in timelines:
+        suicides.update(timeline['suicides'])
+    player_df['suicides'] = player_df['player'].map(suicides).fillna(0).astype(int)
 
     # Teamkills
-    player_df['teamkills'] = 0
-    for round_num, round_feed in enumerate(kill_feed):
-        for kill in round_feed:
-            killer, target = kill[0], kill[1]
-            if get_players_team(killer) == get_players_team(target):
-                player_df.loc[player_df['player'] == killer, 'teamkills'] += 1
+    teamkills = Counter()
+    for timeline in timelines:
+        for killer, target, _ in timeline['kills']:
+            if team_of(player_teams, killer) == team_of(player_teams, target):
+                teamkills[killer] += 1
+    player_df['teamkills'] = player_df['player'].map(teamkills).fillna(0).astype(int)
 
     # 1vX clutches
     player_df['1vX'] = 0
@@ -443,19 +641,75 @@ def parse_json_player_stats(replay_json):
             if round_['teams'][team_index]['won']:
                 player_df.loc[player_df['player'] == team_2_players[0], '1vX'] += 1
 
-    match_id = replay_json['rounds'][0]['recordingProfileID'] + str(replay_json['rounds'][0]['additionalTags']) + replay_json['rounds'][0]['timestamp'].replace('-', '').replace(':', '').replace('Z', '').replace('T', '')
+    match_id = get_match_id(replay_json)
 
     return match_id, player_df
 
 
+def parse_json_round_facts(replay_json, player_teams=None, timelines=None):
+    # One row per player per round
+    match_id = get_match_id(replay_json)
+    time_ = pd.to_datetime(replay_json['rounds'][0]['timestamp'].replace('T', ' ').replace('Z', ''))
+    map_ = replay_json['rounds'][0]['map']['name']
+
+    if player_teams is None:
+        player_teams = get_match_teams(replay_json)
+    if timelines is None:
+        timelines = [round_timeline(round_) for round_ in replay_json['rounds']]
+    team_names = list(dict.fromkeys(player_teams.values()))
+
+    rows = []
+    for round_, timeline in zip(replay_json['rounds'], timelines):
+        kills = timeline['kills']
+        opening_kill = kills[0][0] if kills else None
+        opening_death = kills[0][1] if kills else None
+
+        team_index = {player['username']: player['teamIndex'] for player in round_['players']}
+        for player_stat in round_['stats']:
+            player = player_stat['username']
+            if player not in player_teams or player not in team_index:
+                continue
+            team = player_teams[player]
+            round_team = round_['teams'][team_index[player]]
+            rows.append({
+                'match id': match_id,
+                'time': time_,
+                'map': map_,
+                'round': round_['roundNumber'],
+                'player': player,
+                'team': team,
+                'opponent': next((name for name in team_names if name != team), ''),
+                'side': round_team['role'],
+                'site': round_.get('site', ''),
+                'won': bool(round_team['won']),
+                'kills': player_stat['kills'],
+                'death': bool(player_stat['died']),
+                'plant': player in timeline['plants'],
+                'defuse': player in timeline['defuses'],
+                'trade': player in timeline['trades'],
+                'opening kill': player == opening_kill,
+                'opening death': player == opening_death,
+            })
+
+    return match_id, pd.DataFrame(rows)
+
+
+def get_match_id(replay_json):
+    return replay_json['rounds'][0]['recordingProfileID'] + str(replay_json['rounds'][0]['additionalTags']) + replay_json['rounds'][0]['timestamp'].replace('-', '').replace(':', '').replace('Z', '').replace('T', '')
+
+
+def get_pending_files():
+    return sorted(os.listdir(leagues.path('cache', 'replay_buffer')))
+
+
 def main():
     auth()
-    while True:
-        if os.path.exists('cache/replay_buffer'):
-            files = os.listdir('cache/replay_buffer')
-            for file in files:
-                parse_file(file)
-        sleep(1)
+    reference_data.start(client)
+    for league in leagues.all_leagues():
+        leagues.run_as(league, recover)
+
+    # Each league's replay_buffer is worked through in turn
+    leagues.schedule(get_pending_files, parse_file, job_dir=os.path.join('cache', 'replay_buffer'))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,135 @@
+import json
+import os
+import shutil
+import pandas as pd
+import leagues
+
+# Per player per round facts from replay_parser, one parquet file per map under data/round_facts
+# Two rollups are kept up to date as maps come in, so side/map/opponent breakdowns never re-read the facts:
+#   player_map_side - player x map x side
+#   team_opponent   - team x opponent
+# Both rollups and the list of maps they include are written to a fresh version folder under data/rollups
+# and switched to with one rename of data/rollups/CURRENT, so they can never disagree or count a map twice
+FACTS_DIR = os.path.join('data', 'round_facts')
+ROLLUP_DIR = os.path.join('data', 'rollups')
+ROLLUP_KEYS = {
+    'player_map_side': ['player', 'team', 'map', 'side'],
+    'team_opponent': ['team', 'opponent'],
+}
+COUNTS = ['rounds', 'rounds won', 'kills', 'deaths', 'plants', 'defuses', 'trades', 'opening kills', 'opening deaths']
+
+
+def aggregate(facts):
+    facts = facts.assign(
+        rounds=1,
+        **{
+            'rounds won': facts['won'].astype(int),
+            'deaths': facts['death'].astype(int),
+            'plants': facts['plant'].astype(int),
+            'defuses': facts['defuse'].astype(int),
+            'trades': facts['trade'].astype(int),
+            'opening kills': facts['opening kill'].astype(int),
+            'opening deaths': facts['opening death'].astype(int),
+        }
+    )
+    player_map_side = facts.groupby(ROLLUP_KEYS['player_map_side'], as_index=False)[COUNTS].sum()
+
+    # Team rows are per round, not per player, so rounds and rounds won aren't multiplied by roster size
+    team_rounds = facts.groupby(['match id', 'round', 'team', 'opponent'], as_index=False).agg({
+        'rounds': 'max', 'rounds won': 'max', 'kills': 'sum', 'deaths': 'sum', 'plants': 'sum', 'defuses': 'sum',
+        'trades': 'sum', 'opening kills': 'sum', 'opening deaths': 'sum'
+    })
+    team_opponent = team_rounds.groupby(ROLLUP_KEYS['team_opponent'], as_index=False)[COUNTS].sum()
+    team_opponent['maps'] = team_rounds.groupby(ROLLUP_KEYS['team_opponent'])['match id'].nunique().values
+    return {'player_map_side': player_map_side, 'team_opponent': team_opponent}
+
+
+def current_rollup_dir():
+    pointer = leagues.path(ROLLUP_DIR, 'CURRENT')
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer, 'r') as f:
+        return leagues.path(ROLLUP_DIR, f.read().strip())
+
+
+def load_rollup(name):
+    rollup_dir = current_rollup_dir()
+    if rollup_dir is None:
+        return pd.DataFrame(columns=ROLLUP_KEYS[name] + COUNTS + (['maps'] if name == 'team_opponent' else []))
+    return pd.read_parquet(os.path.join(rollup_dir, f'{name}.parquet'))
+
+
+def rolled_up_matches():
+    rollup_dir = current_rollup_dir()
+    if rollup_dir is None:
+        return []
+    with open(os.path.join(rollup_dir, 'matches.json'), 'r') as f:
+        return json.load(f)
+
+
+def merge(file):
+    facts = pd.read_parquet(leagues.path('cache', 'write_cache', file))
+    if facts.empty:
+        return
+    match_id = facts['match id'].values[0]
+
+    # Fact store, rewriting the same map is harmless
+    os.makedirs(leagues.path(FACTS_DIR), exist_ok=True)
+    facts_file = leagues.path(FACTS_DIR, f'{match_id}.parquet')
+    facts.to_parquet(facts_file + '.tmp', index=False)
+    os.replace(facts_file + '.tmp', facts_file)
+
+    # Rollups
+    matches = rolled_up_matches()
+    if match_id in matches:
+        return
+    new_rollups = aggregate(facts)
+    version = f'v{len(matches) + 1}-{match_id}'
+    version_dir = leagues.path(ROLLUP_DIR, version)
+    os.makedirs(version_dir, exist_ok=True)
+    for name, keys in ROLLUP_KEYS.items():
+        combined = new_rollups[name]
+        if matches:
+            combined = pd.concat([load_rollup(name), combined]).groupby(keys, as_index=False).sum()
+        combined.to_parquet(os.path.join(version_dir, f'{name}.parquet'), index=False)
+    with open(os.path.join(version_dir, 'matches.json'), 'w') as f:
+        json.dump(matches + [match_id], f)
+
+    old_dir = current_rollup_dir()
+    pointer = leagues.path(ROLLUP_DIR, 'CURRENT')
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(version)
+    os.replace(pointer + '.tmp', pointer)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def player_breakdown(player):
+    # Player stats split by map and side, straight from the rollup
+    df = load_rollup('player_map_side')
+    df = df[df['player'] == player].copy()
+    df['K/D'] = df['kills'] / df['deaths'].where(df['deaths'] > 0, 1)
+    df['Win %'] = df['rounds won'] / df['rounds']
+    return df
+
+
+def team_vs(team, opponent=None):
+    df = load_rollup('team_opponent')
+    df = df[df['team'] == team]
+    if opponent is not None:
+        df = df[df['opponent'] == opponent]
+    return df
+
+
+def load_facts(match_ids=None):
+    # Full per round table for ad hoc slicing, optionally only some maps
+    facts_dir = leagues.path(FACTS_DIR)
+    if not os.path.exists(facts_dir):
+        return pd.DataFrame()
+    files = sorted(os.listdir(facts_dir))
+    if match_ids is not None:
+        files = [file for file in files if file[:-len('.parquet')] in match_ids]
+    files = [file for file in files if file.endswith('.parquet')]
+    if not files:
+        return pd.DataFrame()
+    return pd.concat([pd.read_parquet(os.path.join(facts_dir, file)) for file in files], ignore_index=True)
@@ -3,10 +3,17 @@ from gspread.cell import Cell
 from oauth2client.service_account import ServiceAccountCredentials
 import os
 import pandas as pd
-from time import sleep
 import numpy as np
 import warnings
 from colorama import Fore
+import metrics
+import leagues
+import ledger
+import head_to_head
+import rating_history
+import reference_data
+import round_facts
+import stats_snapshot
 
 INFO = f'{Fore.GREEN}[INF]{Fore.RESET} '
 WARN = f'{Fore.YELLOW}[WRN]{Fore.RESET} '
@@ -17,7 +24,6 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 warnings.simplefilter(action='ignore', category=RuntimeWarning)
 
 client = None
-roster_list = None
 # Using https://medium.com/daily-python/python-script-to-edit-google-sheets-daily-python-7-aadce27846c0
 
 
@@ -39,8 +45,8 @@ def update_player_chart_stats():
     print(INFO + '   Updating player chart stats')
 
     # Load stats csv and sheet
-    df = pd.read_csv('data/player_stats.csv')
-    sheet = client.open('QCC 2024 Stats').worksheet('!Chart Data')
+    df = pd.read_csv(leagues.path('data', 'player_stats.csv'))
+    sheet = metrics.worksheet(client, leagues.spreadsheet(), '!Chart Data')
 
     # Top 10 players by K/D (A2:B11) columns are name, kd
     kd_df = df.sort_values(by='K/D', ascending=False).head(10)
@@ -67,19 +73,16 @@ def update_player_chart_stats():
 
 
 def update_bracket():
-    def get_team_group(team):
-        global roster_list
-        if roster_list is None:
-            sheet = client.open('QCC 2024 Stats').worksheet('!Roster List')
-            data = sheet.get_all_values()
-            roster_list = pd.DataFrame(data[1:], columns=data[0])
+    roster_data = reference_data.values(client, '!Roster List')
+    roster_list = pd.DataFrame(roster_data[1:], columns=roster_data[0])
 
+    def get_team_group(team):
         team_row = roster_list[roster_list['Team'] == team]
         group = team_row['Group'].values[0]
         return group
 
     print(INFO + '   Updating standings')
-    sheet = client.open('QCC 2024 Stats').worksheet('!Standings')
+    sheet = metrics.worksheet(client, leagues.spreadsheet(), '!Standings')
     data = sheet.get_all_values()
 
     # Get the team names from A2:A
@@ -112,18 +115,32 @@ def update_bracket():
     sheet.update_cells(cells)
 
 
+def write_csv(df, path):
+    # Swapped in whole so a crash never leaves a half written file behind
+    df.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
 def write_player_stats(file):
     print(INFO + f'Processing player stats from {file}')
+    match_id = ledger.match_for_file(file)
+    update_df = pd.read_csv(leagues.path('cache', 'write_cache', file))
     # If raw player stats doesn't exist, create it from update file
-    if not os.path.exists('data/raw_player_stats.csv'):
-        df = pd.read_csv('cache/write_cache/' + file)
-        df.to_csv('data/raw_player_stats.csv', index=False)
+    if not os.path.exists(leagues.path('data', 'raw_player_stats.csv')):
+        df = update_df
+        with metrics.span('write_csv', file='raw_player_stats.csv'):
+            write_csv(df, leagues.path('data', 'raw_player_stats.csv'))
     # Otherwise, concatentate the two
     else:
-        df = pd.read_csv('cache/write_cache/' + file)
-        raw_df = pd.read_csv('data/raw_player_stats.csv')
+        df = update_df
+        raw_df = pd.read_csv(leagues.path('data', 'raw_player_stats.csv'))
+        # Drop rows left by an earlier attempt at the same map so a retry can't double count
+        if 'match id' in df.columns and 'match id' in raw_df.columns:
+            raw_df = raw_df[raw_df['match id'] != df['match id'].values[0]]
         df = pd.concat([df, raw_df])
-        df.to_csv('data/raw_player_stats.csv', index=False)
+        with metrics.span('write_csv', file='raw_player_stats.csv'):
+            write_csv(df, leagues.path('data', 'raw_player_stats.csv'))
+    ledger.mark('merged', match_id, file=file)
 
     # Create sheet for processed player stats
     processed_df = pd.DataFrame(columns=[
@@ -174,10 +191,14 @@ def write_player_stats(file):
         player_dict['1 v Xs'] = df[df['player'] == player]['1vX'].sum()
 
         # Derived Stats
-        player_dict['KOST'] = df[df['player'] == player]['kost rounds'].sum() / player_dict['Rounds']
-        player_dict['K/D'] = player_dict['K'] / player_dict['D']
-        if player_dict['K/D'] == np.inf:
-            player_dict['K/D'] = player_dict['K']
+        # KOST, K/D and Rating are shared with the rating history
+        player_dict.update(rating_history.stats({
+            'kills': player_dict['K'],
+            'deaths': player_dict['D'],
+            'assists': player_dict['A'],
+            'rounds': player_dict['Rounds'],
+            'kost rounds': df[df['player'] == player]['kost rounds'].sum(),
+        }))
         player_dict['KPR'] = player_dict['K'] / player_dict['Rounds']
         player_dict['SRV'] = 1 - (player_dict['D'] / player_dict['Rounds'])
         player_dict['A/D'] = player_dict['A'] / player_dict['D']
@@ -188,7 +209,6 @@ def write_player_stats(file):
         player_dict['Headshot %'] = df[df['player'] == player]['headshots'].sum() / player_dict['K']
         if player_dict['Headshot %'] == np.inf:
             player_dict['Headshot %'] = df[df['player'] == player]['headshots'].sum()
-        player_dict['Rating'] = 0.7937*player_dict['KPR'] + 0.9091*player_dict['APR'] + 0.9375*player_dict['SRV']
 
         processed_df = pd.concat([processed_df, pd.DataFrame(player_dict, index=[len(processed_df) + 1])])
 
@@ -205,12 +225,19 @@ def write_player_stats(file):
 
     # Write new cell data to sheet
     print(INFO + '   Writing to player stats sheet')
-    sheet = client.open('QCC 2024 Stats').worksheet('!Player Stats')
+    sheet = metrics.worksheet(client, leagues.spreadsheet(), '!Player Stats')
     sheet.batch_clear(['A2:X'])  # Clear all rows except header
     sheet.update_cells(cells)
 
     # Write to data folder
-    processed_df.to_csv('data/player_stats.csv', index=False)
+    with metrics.span('write_csv', file='player_stats.csv'):
+        write_csv(processed_df, leagues.path('data', 'player_stats.csv'))
+    with metrics.span('write_snapshot'):
+        stats_snapshot.write_snapshot(pd.read_csv(leagues.path('data', 'player_stats.csv')))
+    if 'match id' in update_df.columns and 'time' in update_df.columns:
+        with metrics.span('append_rating_history'):
+            rating_history.append(update_df)
+    ledger.mark('published', match_id, file=file)
 
     # Update chart stats
     # update_player_chart_stats()
@@ -220,27 +247,39 @@ def write_match_log(file):
     print(INFO + f'   Writing {file} to sheet match log')
 
     # Load stats csv and sheet
-    df = pd.read_csv('cache/write_cache/' + file)
-    sheet = client.open('QCC 2024 Stats').worksheet('!Match Log')
+    match_id = ledger.match_for_file(file)
+    df = pd.read_csv(leagues.path('cache', 'write_cache', file))
+    new_rows = df
+    sheet = metrics.worksheet(client, leagues.spreadsheet(), '!Match Log')
 
     # If new rows in match log, add to saved match log
-    if os.path.exists('data/match_log.csv'):
-        match_log = pd.read_csv('data/match_log.csv')
+    duplicate = False
+    if os.path.exists(leagues.path('data', 'match_log.csv')):
+        match_log = pd.read_csv(leagues.path('data', 'match_log.csv'))
         for i, row in df.iterrows():
             for j, match_row in match_log.iterrows():
                 if row.equals(match_row):
-                    team_1 = df['Team'].values[0]
-                    team_2 = df['Opponent'].values[0]
-                    time = df['Time'].values[0]
-                    print(WARN + f'   Duplicate match - match {team_1} vs {team_2} at {time} already exists in match log')
-                    return False
+                    duplicate = True
+
+        # Already in the match log but never published means we stopped part way, so carry on publishing
+        if duplicate and ledger.is_done(match_id, 'published', file):
+            team_1 = df['Team'].values[0]
+            team_2 = df['Opponent'].values[0]
+            time = df['Time'].values[0]
+            print(WARN + f'   Duplicate match - match {team_1} vs {team_2} at {time} already exists in match log')
+            return False
         # Add to saved match log
         df = pd.concat([df, match_log])
-    df.to_csv('data/match_log.csv', index=False)
+    if not duplicate:
+        with metrics.span('write_csv', file='match_log.csv'):
+            write_csv(df, leagues.path('data', 'match_log.csv'))
+    with metrics.span('update_head_to_head'):
+        head_to_head.update(new_rows)
+    ledger.mark('merged', match_id, file=file)
 
     # Create cell objects
     print(INFO + '   Writing match log to sheet')
-    df = pd.read_csv('data/match_log.csv')
+    df = pd.read_csv(leagues.path('data', 'match_log.csv'))
     cells = []
     for i, row in df.iterrows():
         for j, cell in enumerate(row):
@@ -252,7 +291,9 @@ def write_match_log(file):
     sheet.update_cells(cells)
 
     #update_bracket()
-    update_map_stats()
+    with metrics.span('update_map_stats'):
+        update_map_stats()
+    ledger.mark('published', match_id, file=file)
     return True
 
 
@@ -270,11 +311,10 @@ def update_map_stats():
     ])
 
     # Load match log
-    df = pd.read_csv('data/match_log.csv')
+    df = pd.read_csv(leagues.path('data', 'match_log.csv'))
 
     # Get all teams and maps
-    filter_sheet = client.open('QCC 2024 Stats').worksheet('!Filters')
-    data = filter_sheet.get_all_values()
+    data = reference_data.values(client, '!Filters')
     teams, maps = [], []
     for row in data[1:]:
         teams.append(row[0])
@@ -332,7 +372,7 @@ def update_map_stats():
 
     # Write to sheet (A2:F)
     print(INFO + '   Writing to map stats sheet')
-    sheet = client.open('QCC 2024 Stats').worksheet('!Map Stats')
+    sheet = metrics.worksheet(client, leagues.spreadsheet(), '!Map Stats')
     cells = []
     for i, row in map_stats_df.iterrows():
         for j, cell in enumerate(row):
@@ -342,35 +382,49 @@ def update_map_stats():
 
 
 def write_data(file):
-    while True:
-        try:
-            sleep(10)
-            with open('cache/write_cache/' + file, 'r') as f:
-                _ = f.read()
-            break
-        except PermissionError:
-            pass
+    # replay_parser renames files into place whole and only after they are in the ledger, so there is no need to
+    # wait for them to settle
+    # Finished before a restart, only the cleanup was left
+    match_id = ledger.match_for_file(file)
+    if ledger.is_done(match_id, 'published', file):
+        print(WARN + f'{file} was already published, clearing it from write cache')
+        os.remove(leagues.path('cache', 'write_cache', file))
+        return
 
     if file.startswith('match_log'):
         print(INFO + f'Processing match {file.replace("match_log-", "").replace(".csv", "")}')
-        duplicate_match = not write_match_log(file)
+        with metrics.span('write_match_log', file=file):
+            duplicate_match = not write_match_log(file)
         print(INFO + f'   Clearing {file} from write cache')
-        os.remove('cache/write_cache/' + file)
+        os.remove(leagues.path('cache', 'write_cache', file))
     elif file.startswith('player_stats'):
-        write_player_stats(file)
+        with metrics.span('write_player_stats', file=file):
+            write_player_stats(file)
         print(INFO + f'   Clearing {file} from write cache')
-        os.remove('cache/write_cache/' + file)
+        os.remove(leagues.path('cache', 'write_cache', file))
+    elif file.startswith('round_facts'):
+        print(INFO + f'Adding round facts from {file}')
+        with metrics.span('write_round_facts', file=file):
+            round_facts.merge(file)
+        # Nothing goes to the sheets, so merged and published are the same step
+        ledger.mark('merged', match_id, file=file)
+        ledger.mark('published', match_id, file=file)
+        print(INFO + f'   Clearing {file} from write cache')
+        os.remove(leagues.path('cache', 'write_cache', file))
+
+
+def get_pending_files():
+    # Skips replay_parser's .tmp files that are still being written, and any file the ledger doesn't know yet
+    files = os.listdir(leagues.path('cache', 'write_cache'))
+    return sorted(file for file in files if file.endswith(('.csv', '.parquet')) and ledger.match_for_file(file) is not None)
 
 
 def main():
     auth()
+    reference_data.start(client)
 
-    while True:
-        # If file in 'write_cache' directory
-        if os.path.exists('cache/write_cache'):
-            files = os.listdir('cache/write_cache')
-            for file in files:
-                write_data(file)
+    # Each league's write_cache is worked through in turn
+    leagues.schedule(get_pending_files, write_data, job_dir=os.path.join('cache', 'write_cache'))
 
 
 if __name__ == '__main__':
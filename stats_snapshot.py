@@ -0,0 +1,103 @@
+import os
+import pickle
+import leagues
+
+# Pre-rendered replies for the bot's teams/stats commands, written by stats_manager whenever player_stats.csv changes
+# Loading it only needs pickle, so the bot can answer without importing pandas or tabulate
+SNAPSHOT_FILE = os.path.join('data', 'player_stats.pkl')
+STATS_FILE = os.path.join('data', 'player_stats.csv')
+
+snapshots = {}  # League name -> (mtime, snapshot)
+
+
+def render_pages(df, team=None):
+    from tabulate import tabulate
+
+    # Team specified, so filter by team
+    if team is not None:
+        df = df[df['Team'] == team]
+        df = df[['Player', 'K/D', 'KOST', 'SRV', 'Rating', 'Headshot %', 'Entry', 'KPR']]
+
+    # No team specified, so show all teams
+    else:
+        df = df[['Team', 'Player', 'K/D', 'KOST', 'SRV', 'Rating', 'Headshot %', 'Entry', 'KPR']]
+
+    # Round K/D, KOST, SRV, Rating, KPR to 2 decimal places
+    df = df.copy()
+    df['K/D'] = df['K/D'].round(2)
+    df['KOST'] = df['KOST'].round(2)
+    df['SRV'] = df['SRV'].round(2)
+    df['Rating'] = df['Rating'].round(2)
+    df['KPR'] = df['KPR'].round(2)
+
+    # Change Headshot % to percentage
+    df['Headshot %'] = (df['Headshot %'] * 100).round()
+
+    # Tabulate
+    table = tabulate(df, headers='keys', tablefmt='fancy_grid', showindex=False)
+
+    # If table string > 2000 characters, split into multiple messages
+    if len(table) > 2000:
+        pages = []
+        lines = table.split('\n')
+
+        start_index = 0
+        char_count = 0
+        for i in range(len(lines)):
+            char_count += len(lines[i])
+            if char_count > 1900:
+                pages.append('```' + '\n'.join(lines[start_index:i]) + '```')
+                char_count = 0
+                start_index = i
+        pages.append('```' + '\n'.join(lines[start_index:]) + '```')
+        return pages
+    if team is None:
+        return [f'```{table}```']
+    return [f'**{team}**\n```{table}```']
+
+
+def build_snapshot(df):
+    teams = sorted(list(df['Team'].unique()))
+    pages = {None: render_pages(df)}
+    for team in teams:
+        pages[team] = render_pages(df, team)
+    return {'teams': teams, 'pages': pages}
+
+
+def write_snapshot(df):
+    snapshot_file = leagues.path(SNAPSHOT_FILE)
+    with open(snapshot_file + '.tmp', 'wb') as f:
+        pickle.dump(build_snapshot(df), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(snapshot_file + '.tmp', snapshot_file)
+
+
+def has_stats():
+    return os.path.exists(leagues.path(SNAPSHOT_FILE)) or os.path.exists(leagues.path(STATS_FILE))
+
+
+def version():
+    # Changes whenever either file the snapshot can come from is rewritten
+    return tuple(os.path.getmtime(file) if os.path.exists(file) else None for file in (leagues.path(SNAPSHOT_FILE), leagues.path(STATS_FILE)))
+
+
+def load_snapshot():
+    league = leagues.current()['name']
+    snapshot_file = leagues.path(SNAPSHOT_FILE)
+    stats_file = leagues.path(STATS_FILE)
+    cached_mtime, snapshot = snapshots.get(league, (None, None))
+
+    # Fall back to the csv if the snapshot is missing or older than it
+    if not os.path.exists(snapshot_file) or (os.path.exists(stats_file) and os.path.getmtime(stats_file) > os.path.getmtime(snapshot_file)):
+        mtime = ('csv', os.path.getmtime(stats_file))
+        if mtime != cached_mtime:
+            import pandas as pd
+            snapshot = build_snapshot(pd.read_csv(stats_file))
+            snapshots[league] = (mtime, snapshot)
+        return snapshot
+
+    mtime = os.path.getmtime(snapshot_file)
+    if mtime != cached_mtime:
+        with open(snapshot_file, 'rb') as f:
+            snapshot = pickle.load(f)
+        snapshots[league] = (mtime, snapshot)
+    return snapshot
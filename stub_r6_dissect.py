@@ -0,0 +1,17 @@
+import os
+import sys
+from time import sleep
+
+# Stand-in for ./r6-dissect used by pipeline_harness.py
+# Prints the canned dissect.json stored in the replay folder after R6_DISSECT_DELAY seconds
+
+
+def main():
+    replay_folder = sys.argv[1]
+    sleep(float(os.getenv('R6_DISSECT_DELAY', '0')))
+    with open(os.path.join(replay_folder, 'dissect.json'), 'r') as f:
+        sys.stdout.write(f.read())
+
+
+if __name__ == '__main__':
+    main()
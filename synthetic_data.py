@@ -0,0 +1,217 @@
+import random
+import string
+from time import sleep
+from datetime import datetime, timedelta
+
+MAPS = {
+    'Bank': 'Bank',
+    'Border': 'Border',
+    'Chalet': 'Chalet',
+    'Clubhouse': 'Clubhouse',
+    'Consulate': 'Consulate',
+    'KafeDostoyevsky': 'Kafe Dostoyevsky',
+    'NighthavenLabs': 'Nighthaven Labs',
+    'Oregon': 'Oregon',
+    'Skyscraper': 'Skyscraper',
+    'ThemePark': 'Theme Park',
+    'Villa': 'Villa',
+}
+SITES = ['1F Kitchen, 1F Dining', '2F Bedroom, 2F Office', 'B Wine Cellar, B Cigar', '1F Lobby, 1F Vault']
+FILLER_EVENTS = ['OperatorSwap', 'LocateObjective', 'BattleyeBan']
+START_TIME = datetime(2024, 4, 12, 21, 0, 0)
+
+
+def team_name(team_num):
+    return f'Team {string.ascii_uppercase[team_num % 26]}{team_num // 26 or ""}'
+
+
+def make_roster(teams=16, players_per_team=5, groups=4):
+    # Rows in the same shape as '!Roster List' (header row first)
+    rows = [['Team'] + [f'Player {c}' for c in range(1, 9)] + ['Group']]
+    for t in range(teams):
+        name = team_name(t)
+        players = [f'{name.replace(" ", "")}_{p}' for p in range(players_per_team)]
+        rows.append([name] + players + [''] * (8 - len(players)) + [str(t % groups + 1)])
+    return rows
+
+
+def make_filters(teams=16):
+    # Rows in the same shape as '!Filters', column A is teams, C is readable map name, D is dissect map name
+    rows = [['Team', '', 'Map', 'Dissect Map']]
+    map_names = list(MAPS.items())
+    for i in range(max(teams, len(map_names))):
+        team = team_name(i) if i < teams else ''
+        dissect_name, readable_name = map_names[i] if i < len(map_names) else ('', '')
+        rows.append([team, '', readable_name, dissect_name])
+    return rows
+
+
+def roster_players(roster, team):
+    for row in roster[1:]:
+        if row[0] == team:
+            return [player for player in row[1:9] if player != '']
+    return []
+
+
+def generate_replay(roster, team_1, team_2, map_name='Clubhouse', rounds=12, kill_density=6.0, feed_density=2.0, start_time=START_TIME, profile_id=None, seed=0):
+    rng = random.Random(seed)
+    players = [roster_players(roster, team_1), roster_players(roster, team_2)]
+    profile_id = profile_id or f'{rng.getrandbits(64):016x}'
+
+    totals = {}
+    for team_idx in range(2):
+        for player in players[team_idx]:
+            totals[player] = {'username': player, 'rounds': 0, 'kills': 0, 'deaths': 0, 'assists': 0, 'headshots': 0}
+
+    round_list = []
+    scores = [0, 0]
+    for round_num in range(rounds):
+        attack_idx = 0 if (round_num < rounds // 2) == (seed % 2 == 0) else 1
+        alive = [list(players[0]), list(players[1])]
+        round_kills = {player: 0 for player in totals}
+        feed = []
+        clock = 180
+
+        # Kill feed, a few seconds apart so trades show up
+        kill_count = min(max(int(rng.gauss(kill_density, 1.5)), 0), len(alive[0]) + len(alive[1]) - 1)
+        for _ in range(kill_count):
+            clock = max(clock - rng.randint(1, 15), 1)
+            killer_team = rng.randint(0, 1)
+            if not alive[killer_team] or not alive[1 - killer_team]:
+                break
+            killer = rng.choice(alive[killer_team])
+            target_team = killer_team if rng.random() < 0.02 else 1 - killer_team
+            target = rng.choice([p for p in alive[target_team] if p != killer] or alive[1 - killer_team])
+            target_team = 0 if target in alive[0] else 1
+            alive[target_team].remove(target)
+            round_kills[killer] += 1
+            totals[killer]['kills'] += 1
+            headshot = rng.random() < 0.4
+            totals[killer]['headshots'] += headshot
+            totals[rng.choice(players[killer_team])]['assists'] += rng.random() < 0.3
+            feed.append({'type': {'name': 'Kill'}, 'username': killer, 'target': target, 'headshot': headshot, 'timeInSeconds': clock})
+            if not alive[0] or not alive[1]:
+                break
+
+        # Objective and filler events
+        planted = alive[attack_idx] and rng.random() < 0.4
+        if planted:
+            feed.append({'type': {'name': 'DefuserPlantComplete'}, 'username': rng.choice(alive[attack_idx]), 'timeInSeconds': max(clock - 5, 1)})
+            if alive[1 - attack_idx] and rng.random() < 0.3:
+                feed.append({'type': {'name': 'DefuserDisableComplete'}, 'username': rng.choice(alive[1 - attack_idx]), 'timeInSeconds': 10})
+        for _ in range(int(feed_density)):
+            feed.insert(rng.randint(0, len(feed)), {'type': {'name': rng.choice(FILLER_EVENTS)}, 'username': rng.choice(list(totals)), 'timeInSeconds': clock})
+
+        # Winner is whoever has more players left, attackers win ties if they planted
+        if len(alive[attack_idx]) > len(alive[1 - attack_idx]) or (planted and len(alive[attack_idx]) == len(alive[1 - attack_idx])):
+            winner = attack_idx
+        else:
+            winner = 1 - attack_idx
+        scores[winner] += 1
+
+        round_stats = []
+        for team_idx in range(2):
+            for player in players[team_idx]:
+                died = player not in alive[team_idx]
+                totals[player]['rounds'] += 1
+                totals[player]['deaths'] += died
+                round_stats.append({'username': player, 'kills': round_kills[player], 'died': died})
+
+        round_list.append({
+            'roundNumber': round_num + 1,
+            'timestamp': (start_time + timedelta(minutes=3 * round_num)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'recordingProfileID': profile_id,
+            'additionalTags': None,
+            'map': {'name': map_name},
+            'site': rng.choice(SITES),
+            'teams': [{'name': 'YOUR TEAM', 'score': scores[i], 'won': winner == i, 'role': 'Attack' if attack_idx == i else 'Defense'} for i in range(2)],
+            'players': [{'username': player, 'teamIndex': team_idx} for team_idx in range(2) for player in players[team_idx]],
+            'stats': round_stats,
+            'matchFeedback': feed if feed or rng.random() < 0.5 else None,
+        })
+
+    return {'rounds': round_list, 'stats': list(totals.values())}
+
+
+def generate_series(roster, team_1, team_2, maps=3, rounds=12, kill_density=6.0, feed_density=2.0, rehost_map=None, start_time=START_TIME, seed=0):
+    # A rehost splits one map into two consecutive replays of the same map
+    rng = random.Random(seed)
+    map_names = rng.sample(list(MAPS), maps)
+    replay_jsons = []
+    for map_num, map_name in enumerate(map_names):
+        map_time = start_time + timedelta(hours=map_num)
+        if map_num == rehost_map:
+            first_half = max(rounds // 3, 1)
+            replay_jsons.append(generate_replay(roster, team_1, team_2, map_name, first_half, kill_density, feed_density, map_time, seed=seed + map_num * 2))
+            map_time += timedelta(minutes=3 * first_half + 5)
+            replay_jsons.append(generate_replay(roster, team_1, team_2, map_name, rounds - first_half, kill_density, feed_density, map_time, seed=seed + map_num * 2 + 1))
+        else:
+            replay_jsons.append(generate_replay(roster, team_1, team_2, map_name, rounds, kill_density, feed_density, map_time, seed=seed + map_num * 2))
+    return replay_jsons
+
+
+class FakeWorksheet:
+    def __init__(self, title, values=None, latency=0):
+        self.title = title
+        self.values = [list(row) for row in values or []]
+        self.latency = latency
+        self.calls = 0
+
+    def call(self):
+        self.calls += 1
+        if self.latency:
+            sleep(self.latency)
+
+    def get_all_values(self):
+        self.call()
+        return [list(row) for row in self.values]
+
+    def get_all_records(self):
+        self.call()
+        header = self.values[0]
+        return [dict(zip(header, row)) for row in self.values[1:]]
+
+    def batch_clear(self, ranges):
+        self.call()
+
+    def update_cells(self, cells):
+        self.call()
+        for cell in cells:
+            while len(self.values) < cell.row:
+                self.values.append([])
+            row = self.values[cell.row - 1]
+            while len(row) < cell.col:
+                row.append('')
+            row[cell.col - 1] = cell.value
+
+
+class FakeSpreadsheet:
+    def __init__(self, worksheets, latency=0):
+        self.worksheets = worksheets
+        self.latency = latency
+
+    def worksheet(self, title):
+        if title not in self.worksheets:
+            self.worksheets[title] = FakeWorksheet(title, latency=self.latency)
+        return self.worksheets[title]
+
+
+class FakeClient:
+    # Stands in for an authorized gspread client, everything lives in memory
+    # latency is the number of seconds each sheet call sleeps for, to mimic the real API
+    def __init__(self, roster=None, filters=None, latency=0):
+        self.spreadsheets = {}
+        self.latency = latency
+        self.roster = roster or make_roster()
+        self.filters = filters or make_filters(len(self.roster) - 1)
+
+    def open(self, name):
+        if name not in self.spreadsheets:
+            self.spreadsheets[name] = FakeSpreadsheet({
+                '!Roster List': FakeWorksheet('!Roster List', self.roster, self.latency),
+                '!Filters': FakeWorksheet('!Filters', self.filters, self.latency),
+            }, self.latency)
+        return self.spreadsheets[name]
+
+    def calls(self):
+        return sum(sheet.calls for spreadsheet in self.spreadsheets.values() for sheet in spreadsheet.worksheets.values())